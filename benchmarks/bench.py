@@ -0,0 +1,266 @@
+"""Benchmarks for sailor's hot paths, without a terminal.
+
+Run from this directory:
+
+    python bench.py --output before.json
+    python bench.py --compare before.json
+"""
+# Load sailor from one directory higher
+import sys
+sys.path.insert(0, '..')
+
+import argparse
+import curses
+import gc
+import json
+import logging
+import resource
+import time
+import sailor as s
+
+
+def build_tree(width, depth, leaves):
+  """Return a tree of Panels and Stackeds, width children per level."""
+  if depth == 0:
+    leaf = s.Edit('leaf %d' % len(leaves)) if len(leaves) % 2 else s.Text('leaf %d' % len(leaves))
+    leaves.append(leaf)
+    return leaf
+  children = [build_tree(width, depth - 1, leaves) for _ in range(width)]
+  return s.Panel(children) if depth % 2 else s.Stacked(children)
+
+
+class LayoutStress(s.Control):
+  """Renders a big nest of Horizontal, Vertical, Grid and Box views."""
+  def __init__(self, rows, cols):
+    super(LayoutStress, self).__init__()
+    self.rows = rows
+    self.cols = cols
+    self.generation = 0
+
+  def render(self, app):
+    cell = lambda i, j: s.Display('%d:%d:%d' % (self.generation, i, j))
+    grid = s.Grid([[cell(i, j) for j in range(self.cols)] for i in range(self.rows)])
+    rows = s.Vertical([s.Horizontal([cell(i, j) for j in range(self.cols)]) for i in range(self.rows)])
+    return s.Box(s.Vertical([s.Box(grid), s.Box(rows)]))
+
+
+def summarize(times, events=1):
+  times = sorted(times)
+  total = sum(times)
+  return {
+      'runs': len(times),
+      'mean_ms': round(1000 * total / len(times), 4),
+      'median_ms': round(1000 * times[len(times) // 2], 4),
+      'p95_ms': round(1000 * times[min(len(times) - 1, int(len(times) * 0.95))], 4),
+      'max_ms': round(1000 * times[-1], 4),
+      'per_second': round(events * len(times) / total, 1) if total else None,
+      }
+
+
+def measure(fn, runs, events=1):
+  """Time runs calls of fn, and count the objects that they leave behind.
+
+  Like timeit, this turns off the garbage collector while timing. Objects in
+  reference cycles are then only freed by the gc.collect() afterwards, which
+  counts them.
+  """
+  fn()  # Warm up caches
+  gc.collect()
+  objects = len(gc.get_objects())
+  times = []
+  gc.disable()
+  try:
+    for _ in xrange(runs):
+      start = time.time()
+      fn()
+      times.append(time.time() - start)
+  finally:
+    gc.enable()
+  result = summarize(times, events)
+  result['cyclic_garbage_per_run'] = round(float(gc.collect()) / runs, 2)
+  result['retained_objects_per_run'] = round(float(len(gc.get_objects()) - objects) / runs, 2)
+  return result
+
+
+def headless_app(root, width, height):
+  app = s.App(root)
+  app.screen = s.VirtualScreen(width, height)
+  app.update()
+  return app
+
+
+def close(app):
+  app.close()
+  app.screen.close()
+
+
+def key(app, k):
+  app.dispatch_event(s.Event('key', k, app.active_layer.focused, app))
+
+
+def bench_frames(args):
+  leaves = []
+  app = headless_app(build_tree(args.width, args.depth, leaves), args.screen_width, args.screen_height)
+
+  def full():
+    app.invalidate()
+    app.update()
+
+  counter = [0]
+  def incremental():
+    counter[0] += 1
+    leaves[counter[0] % len(leaves)].value = 'changed %d' % counter[0]
+    app.update()
+
+  try:
+    return {
+        'controls': len(list(s.object_tree(app))),
+        'full_frame': measure(full, args.frames),
+        'incremental_frame': measure(incremental, args.frames),
+        }
+  finally:
+    close(app)
+
+
+def bench_layout(args):
+  stress = LayoutStress(args.grid_rows, args.grid_cols)
+  app = headless_app(s.Stacked([stress]), args.screen_width, args.screen_height)
+
+  def frame():
+    stress.generation += 1
+    app.update()
+
+  try:
+    return {'layout_frame': measure(frame, args.frames)}
+  finally:
+    close(app)
+
+
+def bench_dispatch(args):
+  leaves = []
+  app = headless_app(build_tree(args.width, args.depth, leaves), args.screen_width, args.screen_height)
+  deepest = [l for l in leaves if l.can_focus][-1]
+  app.active_layer.focus(deepest)
+  batch = 1000
+
+  def dispatch():
+    for _ in xrange(batch):
+      # Nobody handles this key, so it goes all the way up to the app
+      key(app, curses.KEY_F5)
+
+  try:
+    return {
+        'depth': len(app.ancestors(deepest)),
+        'dispatch': measure(dispatch, max(1, args.frames // 10), events=batch),
+        }
+  finally:
+    close(app)
+
+
+def bench_select_list(args):
+  select = s.SelectList(['row %d' % i for i in xrange(args.rows)], height=args.screen_height - 4)
+  app = headless_app(s.Panel([select]), args.screen_width, args.screen_height)
+
+  def scroll(k):
+    def step():
+      if select.index >= args.rows - 1:
+        select.index = 0
+      key(app, k)
+      app.update()
+    return step
+
+  try:
+    return {
+        'select_list_line_down': measure(scroll(curses.KEY_DOWN), args.frames),
+        'select_list_page_down': measure(scroll(curses.KEY_NPAGE), args.frames),
+        }
+  finally:
+    close(app)
+
+
+def bench_preview_pane(args):
+  text = '\n'.join('line %d of the preview pane with some text in it' % i for i in xrange(args.lines))
+  pane = s.PreviewPane(text)
+  app = headless_app(s.Panel([pane]), args.screen_width, args.screen_height)
+
+  def scroll(k):
+    def step():
+      if pane.v_scroll_offset >= args.lines - args.screen_height:
+        pane.v_scroll_offset = 0
+      key(app, k)
+      app.update()
+    return step
+
+  try:
+    return {
+        'preview_line_down': measure(scroll(curses.KEY_DOWN), args.frames),
+        'preview_page_down': measure(scroll(curses.KEY_NPAGE), args.frames),
+        }
+  finally:
+    close(app)
+
+
+BENCHMARKS = [
+    ('frames', bench_frames),
+    ('layout', bench_layout),
+    ('dispatch', bench_dispatch),
+    ('select_list', bench_select_list),
+    ('preview_pane', bench_preview_pane),
+    ]
+
+
+def compare(results, baseline):
+  """Print how the mean times compare to an earlier run."""
+  print '%-24s %13s  %13s' % ('', 'before', 'after')
+  for group, numbers in sorted(results.items()):
+    for name, result in sorted(numbers.items()):
+      before = baseline.get(group, {}).get(name)
+      if isinstance(result, dict) and isinstance(before, dict) and before.get('mean_ms'):
+        print '%-24s %10.4f ms  %10.4f ms  %+6.1f%%' % (
+            name, before['mean_ms'], result['mean_ms'],
+            100.0 * (result['mean_ms'] - before['mean_ms']) / before['mean_ms'])
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark sailor without a terminal.')
+  parser.add_argument('--width', type=int, default=4, help='children per control in the tree')
+  parser.add_argument('--depth', type=int, default=4, help='levels of controls in the tree')
+  parser.add_argument('--rows', type=int, default=100000, help='rows in the SelectList')
+  parser.add_argument('--lines', type=int, default=100000, help='lines in the PreviewPane')
+  parser.add_argument('--grid-rows', type=int, default=20)
+  parser.add_argument('--grid-cols', type=int, default=8)
+  parser.add_argument('--screen-width', type=int, default=200)
+  parser.add_argument('--screen-height', type=int, default=60)
+  parser.add_argument('--frames', type=int, default=200, help='runs per benchmark')
+  parser.add_argument('--only', action='append', help='only run this benchmark (repeatable)')
+  parser.add_argument('--output', help='write the results to this JSON file')
+  parser.add_argument('--compare', help='compare with the results in this JSON file')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.ERROR)
+
+  results = {}
+  for name, bench in BENCHMARKS:
+    if args.only and name not in args.only:
+      continue
+    start = time.time()
+    results[name] = bench(args)
+    print >>sys.stderr, '%-14s done in %.1fs' % (name, time.time() - start)
+
+  report = {
+      'python': sys.version.split()[0],
+      'params': vars(args),
+      'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+      'results': results,
+      }
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2, sort_keys=True)
+  if args.compare:
+    with open(args.compare) as f:
+      compare(results, json.load(f)['results'])
+  else:
+    print json.dumps(report, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+  main()
@@ -28,9 +28,11 @@ def show_popup(app):
   popup.show(app)
 
 
+WORDS = ['foo', 'bar', 'baz', 'sailor', 'curses', 'walk', 'hello', 'world']
+
+
 def complete_fn(word):
-  candidates = ['foo', 'bar', 'baz', 'sailor', 'curses', 'walk', 'hello', 'world']
-  return [w for w in candidates if w.startswith(word)]
+  return [w for w in WORDS if w.startswith(word)]
 
 def main():
   SWITCHABLES = [
@@ -60,6 +62,8 @@ def main():
       s.Labeled('Popup', s.Button('Hit me', on_click=show_popup)),
       s.Labeled('Edit', s.Edit('you can edit this')),
       s.Labeled('AutoComplete', s.AutoCompleteEdit('type here', complete_fn)),
+      s.Labeled('Completer', s.AutoCompleteEdit('or here', s.Completer(WORDS), background=False, delay=0,
+                                                narrow=s.prefix_completions)),
       s.Labeled('SwitchableCtrl', switchable),
       s.Labeled('', s.Button('Next', on_click=do_next)),
       s.Labeled('Button', s.Button('Exit', on_click=do_exit)),
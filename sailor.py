@@ -1,12 +1,31 @@
+import array
+import bisect
 import calendar
+import collections
 import curses
 import curses.ascii
-from curses import textpad
+import ctypes
+import ctypes.util
 import datetime
+import errno
+import fcntl
+import heapq
 import itertools
 import logging
+import math
+import mmap
+import multiprocessing
+import multiprocessing.pool
+import operator
 import os
+import random
+import re
+import select
+import stat
 import string
+import sys
+import time
+import types
 
 logger = logging.getLogger('sailor')
 
@@ -23,6 +42,17 @@ SHIFT_TAB = 353
 CR = 13  # Or Ctrl-M, so don't use that
 OTHER_DEL = 330
 
+# Terminals send pasted text between these markers in bracketed paste mode
+PASTE_START = [curses.ascii.ESC] + [ord(c) for c in '[200~']
+PASTE_END = [curses.ascii.ESC] + [ord(c) for c in '[201~']
+PASTE_WAIT_MS = 25  # How long to wait for the rest of a paste
+PASTE_CONTROL_KEYS = [ord('\t'), ord('\n'), CR]  # The only control keys that are kept in pastes
+
+STATS_KEY = curses.KEY_F12  # Shows the profiler stats, when profiling
+
+# Attribute values that can't change without being assigned
+IMMUTABLE_TYPES = (bool, int, long, float, basestring, type(None))
+
 black = curses.COLOR_BLACK
 red = curses.COLOR_RED
 green = curses.COLOR_GREEN
@@ -32,8 +62,86 @@ cyan = curses.COLOR_CYAN
 magenta = curses.COLOR_MAGENTA
 yellow = curses.COLOR_YELLOW
 
+
+def color_pair(pair):
+  """Return the attribute for a color pair, like curses.color_pair().
+
+  This one also works without a terminal.
+  """
+  return (pair << 8) & curses.A_COLOR
+
+
+def acs(name, fallback):
+  """Return a line drawing character, or fallback without a terminal."""
+  return getattr(curses, name, ord(fallback))
+
+
+def rectangle(win, uly, ulx, lry, lrx):
+  """Draw a rectangle with corners at the given coordinates, like textpad.rectangle()."""
+  win.vline(uly + 1, ulx, acs('ACS_VLINE', '|'), lry - uly - 1)
+  win.hline(uly, ulx + 1, acs('ACS_HLINE', '-'), lrx - ulx - 1)
+  win.hline(lry, ulx + 1, acs('ACS_HLINE', '-'), lrx - ulx - 1)
+  win.vline(uly + 1, lrx, acs('ACS_VLINE', '|'), lry - uly - 1)
+  win.addch(uly, ulx, acs('ACS_ULCORNER', '+'))
+  win.addch(uly, lrx, acs('ACS_URCORNER', '+'))
+  win.addch(lry, lrx, acs('ACS_LRCORNER', '+'))
+  win.addch(lry, ulx, acs('ACS_LLCORNER', '+'))
+
+
+def rgb(r, g, b):
+  """Return the color that is closest to the given 0-255 components.
+
+  This is a color of the 256-color palette. Terminals with fewer colors show
+  the closest basic color instead.
+  """
+  level = lambda v: (v * 5 + 127) // 255
+  return 16 + 36 * level(r) + 6 * level(g) + level(b)
+
+
+def basic_color(color):
+  """Return the closest of the 8 basic colors to a 256-color palette color."""
+  if color < 8:
+    return color
+  if color < 16:
+    return color - 8
+  if color >= 232:
+    return white if color >= 244 else black
+  r, g, b = (color - 16) // 36, (color - 16) // 6 % 6, (color - 16) % 6
+  return (curses.COLOR_RED if r >= 3 else 0) | (curses.COLOR_GREEN if g >= 3 else 0) | (curses.COLOR_BLUE if b >= 3 else 0)
+
 # FIXME: Crash when running off the edges
 
+def posix_monotonic():
+  """Return a clock_gettime(CLOCK_MONOTONIC) function, or None if there is none."""
+  class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+  CLOCK_MONOTONIC = 1  # Linux
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    clock_gettime = libc.clock_gettime
+  except (OSError, AttributeError):
+    return None
+
+  def monotonic():
+    ts = timespec()
+    if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+      raise OSError(ctypes.get_errno(), 'clock_gettime() failed')
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+  try:
+    monotonic()
+  except OSError:
+    return None
+  return monotonic
+
+
+# Seconds from a clock that doesn't jump when the wall clock is changed
+monotonic = (getattr(time, 'monotonic', None)
+             or (os.uname()[0] == 'Linux' and posix_monotonic())
+             or time.time)
+
+
 def reduce_esc_delay():
   try:
     os.environ['ESCDELAY']
@@ -41,6 +149,68 @@ def reduce_esc_delay():
     os.environ['ESCDELAY'] = '25'
 
 
+def set_bracketed_paste(enabled):
+  """Ask the terminal to mark pasted text, so it can be told apart from typing."""
+  sys.stdout.write('\x1b[?2004h' if enabled else '\x1b[?2004l')
+  sys.stdout.flush()
+
+
+def is_task(x):
+  """Whether a handler returned a task (a generator) that the app should run."""
+  return isinstance(x, types.GeneratorType)
+
+
+def run_steps(ctrl, job, current, on_step=None):
+  """Do the first step of a job for ctrl now, and the rest in between frames.
+
+  job has step(), done and running. The steps stop once current() is false,
+  for instance because the job was replaced; they go on if it becomes
+  current again. Without an app, all steps are done right away. on_step() is
+  called after every step.
+  """
+  if job.done or job.running:
+    return
+  job.step()
+  if on_step:
+    on_step()
+  if job.done:
+    return
+  if not ctrl._app:
+    while not job.done:
+      job.step()
+    if on_step:
+      on_step()
+    return
+  job.running = True
+  ctrl._app.spawn(_continue_steps(ctrl, job, current, on_step))
+
+
+def _continue_steps(ctrl, job, current, on_step):
+  try:
+    while True:
+      yield 0
+      if job.done or not current():
+        return
+      job.step()
+      if on_step:
+        on_step()
+      ctrl.invalidate()
+  finally:
+    job.running = False
+
+
+def fileno(f):
+  return f if isinstance(f, (int, long)) else f.fileno()
+
+
+def call_catching(fn, args, kwargs):
+  """Call fn in a worker, returning (True, result) or (False, exception)."""
+  try:
+    return True, fn(*args, **kwargs)
+  except Exception, e:
+    return False, e
+
+
 def is_enter(ev):
   return ev.key in [curses.KEY_ENTER, CR]
 
@@ -53,11 +223,17 @@ def get_value(x):
   return x.value if isinstance(x, Option) else x
 
 
+def prefix_completions(word, completions):
+  """Return the completions that start with word."""
+  return [c for c in completions if str(get_value(c)).startswith(word)]
+
+
 def flatten(listOfLists):
     return itertools.chain.from_iterable(listOfLists)
 
 
 class Colorized(object):
+  """Colored text, to put in strings that StyledText.decode() understands."""
   def __init__(self, text, color, attr=0):
     self.text = text
     self.color = color
@@ -67,6 +243,53 @@ class Colorized(object):
     return '\0' + str(self.color) + '\1' + str(self.attr) + '\1' + str(self.text) + '\0'
 
 
+class StyledText(object):
+  """A line of text made of spans that each have their own style.
+
+  Every span is (text, fg, bg, attr). A color of None means the color of the
+  Display that shows the text, and attr is added to its attributes.
+  """
+  def __init__(self, text='', fg=None, bg=None, attr=0):
+    self.spans = []
+    self.offsets = []  # Start of every span
+    self.width = 0
+    self.append(text, fg, bg, attr)
+
+  def append(self, text, fg=None, bg=None, attr=0):
+    if text:
+      self.spans.append((text, fg, bg, attr))
+      self.offsets.append(self.width)
+      self.width += len(text)
+    return self
+
+  def __len__(self):
+    return self.width
+
+  def __str__(self):
+    return ''.join(span[0] for span in self.spans)
+
+  def span_at(self, x):
+    """Return the (char, fg, bg, attr) at position x, or None if it is past the end."""
+    if not 0 <= x < self.width:
+      return None
+    i = bisect.bisect_right(self.offsets, x) - 1
+    text, fg, bg, attr = self.spans[i]
+    return text[x - self.offsets[i]], fg, bg, attr
+
+  @classmethod
+  def decode(cls, text):
+    """Make StyledText out of a string with str(Colorized(...)) parts in it."""
+    styled = cls()
+    parts = text.split('\0')
+    for i in range(0, len(parts), 2):
+      # i is regular, i+1 is colorized (if it's there)
+      styled.append(parts[i])
+      if i + 1 < len(parts):
+        color, attr, part = parts[i+1].split('\1')
+        styled.append(part, fg=int(color), attr=int(attr))
+    return styled
+
+
 def handle_scroll_key(key, current_row, row_count, scroll_offset, win_height, page_size=10):
     """Handle scrolling one or more lines based on key presses.
 
@@ -113,6 +336,13 @@ class View(object):
     """Return the size that the view takes up."""
     return (0, 0)
 
+  def measure(self, rect):
+    """Return size(rect), measuring only once per frame.
+
+    Views should use this to get the size of their inner views.
+    """
+    return rect.app.measure(self, rect)
+
   def display(self, rect):
     """Render the view inside the given rectangle."""
     self.rect = rect
@@ -125,20 +355,27 @@ class View(object):
 
 
 class Display(View):
-  """A view that displays literal characters."""
-  def __init__(self, text, min_width=0, fg=white, bg=black, attr=0):
+  """A view that displays literal characters.
+
+  Lines can also be StyledText. To show a cursor, pass the (x, y) of the
+  character it is on as cursor.
+  """
+  def __init__(self, text, min_width=0, fg=white, bg=black, attr=0, cursor=None):
     if isinstance(text, list):
       self.lines = text
+    elif isinstance(text, StyledText):
+      self.lines = [text]
     else:
       self.lines = str(text).split('\n')
     self.fg = fg
     self.bg = bg
     self.min_width = min_width
     self.attr = attr
+    self.cursor = cursor
 
   @property
   def text(self):
-    return '\n'.join(self.lines)
+    return '\n'.join(str(l) for l in self.lines)
 
   def size(self, rect):
     return max(self.min_width, max(len(l) for l in self.lines)), len(self.lines)
@@ -149,11 +386,47 @@ class Display(View):
     lines = self.lines[:rect.h]
     if print_width > 0 and lines:
       for i, line in enumerate(lines):
-        padding = ' ' * min(print_width, self.min_width - len(line))
-        try:
-          rect.screen.addstr(rect.y + i, rect.x, line[:print_width] + padding, curses.color_pair(col) | self.attr)
-        except curses.error, e:
-          logger.warn(str(e))
+        if isinstance(line, StyledText):
+          self._disp_styled(rect, i, line, print_width)
+          continue
+        line = line[:print_width]
+        padding = ' ' * max(0, min(print_width, self.min_width) - len(line))
+        self._addstr(rect, 0, i, line + padding, color_pair(col) | self.attr)
+      if self.cursor:
+        self._disp_cursor(rect, lines, print_width)
+
+  def _disp_styled(self, rect, y, line, print_width):
+    x = 0
+    for text, fg, bg, attr in line.spans:
+      if x >= print_width:
+        break
+      text = text[:print_width - x]
+      col = rect.get_color(self.fg if fg is None else fg, self.bg if bg is None else bg)
+      self._addstr(rect, x, y, text, color_pair(col) | self.attr | attr)
+      x += len(text)
+    padding = min(print_width, self.min_width) - x
+    if padding > 0:
+      self._addstr(rect, x, y, ' ' * padding, color_pair(rect.get_color(self.fg, self.bg)) | self.attr)
+
+  def _disp_cursor(self, rect, lines, print_width):
+    """Paint the character under the cursor again, standing out."""
+    x, y = self.cursor
+    if not (0 <= y < len(lines) and 0 <= x < print_width):
+      return
+    line = lines[y]
+    fg, bg, attr = None, None, 0
+    if isinstance(line, StyledText):
+      ch, fg, bg, attr = line.span_at(x) or (' ', None, None, 0)
+    else:
+      ch = line[x] if x < len(line) else ' '
+    col = rect.get_color(self.fg if fg is None else fg, self.bg if bg is None else bg)
+    self._addstr(rect, x, y, ch, color_pair(col) | self.attr | attr | curses.A_STANDOUT)
+
+  def _addstr(self, rect, x, y, text, attr):
+    try:
+      rect.screen.addstr(rect.y + y, rect.x + x, text, attr)
+    except curses.error, e:
+      logger.warn(str(e))
 
 
 class Positioned(View):
@@ -164,10 +437,10 @@ class Positioned(View):
     self.y = y
 
   def size(self, rect):
-    return self.inner.size(rect)
+    return self.inner.measure(rect)
 
   def disp(self, rect):
-    size = self.size(rect)
+    size = self.measure(rect)
 
     x = max(0, min(self.x, rect.w - size[0]))
     irect = Rect(rect.app, rect.screen, x, self.y, size[0], size[1])
@@ -181,10 +454,10 @@ class Centered(View):
     self.inner = inner
 
   def size(self, rect):
-    return rect
+    return rect.w, rect.h
 
   def disp(self, rect):
-    size = self.inner.size(rect)
+    size = self.inner.measure(rect)
     x = (rect.w - size[0]) / 2
     y = (rect.h - size[1]) / 2
     irect = rect.sub_rect(x, y, size[0], size[1])
@@ -202,7 +475,7 @@ class AlignRight(View):
     return rect.w, rect.h
 
   def disp(self, rect):
-    w, h = self.inner.size(rect)
+    w, h = self.inner.measure(rect)
     irect = rect.adj_rect(rect.w - w - self.h_margin, self.v_margin)
     self.inner.display(irect)
 
@@ -219,7 +492,7 @@ class HFill(View):
 
   def disp(self, rect):
     col = rect.get_color(self.fg, self.bg)
-    rect.screen.addstr(rect.y, rect.x, self.char * rect.w, curses.color_pair(col))
+    rect.screen.addstr(rect.y, rect.x, self.char * rect.w, color_pair(col))
 
 
 class Horizontal(View):
@@ -232,8 +505,8 @@ class Horizontal(View):
   def size(self, rect):
     sizes = []
     for v in self.views:
-      sizes.append(v.size(rect))
-      rect = rect.adj_rect(sizes[-1][0], 0)
+      sizes.append(v.measure(rect))
+      rect = rect.adj_rect(sizes[-1][0] + self.margin, 0)
 
     widths = [s[0] for s in sizes]
     heights = [s[1] for s in sizes]
@@ -242,40 +515,138 @@ class Horizontal(View):
   def disp(self, rect):
     for v in self.views:
       v.display(rect)
-      dx = v.size(rect)[0] + self.margin
+      dx = v.measure(rect)[0] + self.margin
       rect = rect.adj_rect(dx, 0)
 
 
+class Span(View):
+  """A view that takes up more than one column and/or row of a Grid."""
+  def __init__(self, inner, cols=1, rows=1):
+    self.inner = inner
+    self.cols = cols
+    self.rows = rows
+
+  def size(self, rect):
+    return self.inner.measure(rect)
+
+  def disp(self, rect):
+    self.inner.display(rect)
+
+
 class Grid(View):
-  """A view that lays out other views in a grid."""
-  def __init__(self, grid, h_margin=1, align_right=False):
+  """A view that lays out other views in a grid.
+
+  `grid` is a list of rows, each a list of views. Wrap a view in Span to
+  make it take up multiple columns or rows; the cells it covers are skipped
+  in the rows that follow.
+
+  `flex` is a list of weights, one per column. Columns with a weight share
+  the width that is left over, making the grid fill the available width.
+  """
+  def __init__(self, grid, h_margin=1, align_right=False, v_margin=0, flex=None):
     self.grid = grid
     self.h_margin = h_margin
+    self.v_margin = v_margin
     self.align_right = align_right
+    self.flex = flex or []
+    self.cells = self._place_cells()
+    self.layout_key = None
+
+  def _place_cells(self):
+    """Return (row, col, rows, cols, view) for every cell, in row order."""
+    cells = []
+    covered = set()  # Positions covered by cells spanning from earlier rows
+    for j, row in enumerate(self.grid):
+      i = 0
+      for view in row:
+        while (j, i) in covered:
+          i += 1
+        rows, cols = (view.rows, view.cols) if isinstance(view, Span) else (1, 1)
+        for dj in range(1, rows):
+          for di in range(cols):
+            covered.add((j + dj, i + di))
+        cells.append((j, i, rows, cols, view))
+        i += cols
+    return cells
+
+  def _layout(self, rect):
+    """Measure all cells, and calculate the sizes and offsets of rows and columns."""
+    self.layout_key = (rect.w, rect.h)
+    self.cell_sizes = [view.measure(rect) for _, _, _, _, view in self.cells]
+
+    n_rows = max([len(self.grid)] + [j + rows for j, _, rows, _, _ in self.cells])
+    n_cols = max([0] + [i + cols for _, i, _, cols, _ in self.cells])
+    self.row_heights = [0] * n_rows
+    self.col_widths = [0] * n_cols
+
+    spanning = []
+    for (j, i, rows, cols, _), (w, h) in zip(self.cells, self.cell_sizes):
+      if cols == 1:
+        self.col_widths[i] = max(self.col_widths[i], w)
+      if rows == 1:
+        self.row_heights[j] = max(self.row_heights[j], h)
+      if rows > 1 or cols > 1:
+        spanning.append((j, i, rows, cols, w, h))
+
+    # Spanning cells that don't fit grow the last row/column they cover
+    for j, i, rows, cols, w, h in spanning:
+      have = sum(self.col_widths[i:i + cols]) + (cols - 1) * self.h_margin
+      self.col_widths[i + cols - 1] += max(0, w - have)
+      have = sum(self.row_heights[j:j + rows]) + (rows - 1) * self.v_margin
+      self.row_heights[j + rows - 1] += max(0, h - have)
+
+    self._distribute_flex(rect.w)
+
+    self.col_offsets = self._offsets(self.col_widths, self.h_margin)
+    self.row_offsets = self._offsets(self.row_heights, self.v_margin)
+
+  def _distribute_flex(self, available):
+    weights = [self.flex[i] if i < len(self.flex) else 0 for i in range(len(self.col_widths))]
+    total = sum(weights)
+    extra = available - (sum(self.col_widths) + max(0, len(self.col_widths) - 1) * self.h_margin)
+    if total <= 0 or extra <= 0:
+      return
+
+    given = 0
+    for i, weight in enumerate(weights):
+      share = extra * weight / total
+      self.col_widths[i] += share
+      given += share
+    # What is left after rounding goes to the last flexible column
+    last = max(i for i, weight in enumerate(weights) if weight > 0)
+    self.col_widths[last] += extra - given
+
+  def _offsets(self, sizes, margin):
+    """Return the starting offsets of the sizes, plus the total size at the end."""
+    ret = []
+    offset = 0
+    for size in sizes:
+      ret.append(offset)
+      offset += size + margin
+    ret.append(max(0, offset - margin))
+    return ret
 
   def size(self, rect):
-    # FIXME: Not correct for size-adapting controls
-    self.size_grid = [[col.size(rect) for col in row]
-                      for row in self.grid]
-    cols = len(self.size_grid[0])
-    self.col_widths = [max(self.size_grid[i][col_nr][0] for i in range(len(self.size_grid)))
-                       for col_nr in range(cols)]
-    self.row_heights = [max(col[1] for col in row)
-                        for row in self.size_grid]
-    w = sum(self.col_widths) + (len(self.col_widths) - 1) * self.h_margin
-    h = sum(self.row_heights)
-    return w, h
+    self._layout(rect)
+    return self.col_offsets[-1], self.row_offsets[-1]
 
   def disp(self, rect):
-    for j, row in enumerate(self.grid):
-      rrect = rect.adj_rect(0, sum(self.row_heights[:j]))
-      for i, cell in enumerate(row):
-        col_width = self.col_widths[i]
-        cell_size = cell.size(rect)
-        if self.align_right:
-          rrect = rrect.adj_rect(col_width - cell_size[0], 0)
-        cell.display(rrect)
-        rrect = rrect.adj_rect(cell_size[0] + self.h_margin, 0)
+    self.measure(rect)
+    if self.layout_key != (rect.w, rect.h):
+      self._layout(rect)
+
+    for (j, i, rows, cols, view), (w, h) in zip(self.cells, self.cell_sizes):
+      y = self.row_offsets[j]
+      if y >= rect.h:
+        # Cells are in row order, the rest are all out of view
+        break
+      x = self.col_offsets[i]
+      cell_w = self.col_offsets[i + cols - 1] + self.col_widths[i + cols - 1] - x
+      cell_h = self.row_offsets[j + rows - 1] + self.row_heights[j + rows - 1] - y
+      if self.align_right:
+        x += max(0, cell_w - w)
+        cell_w = min(w, cell_w)
+      view.display(rect.sub_rect(x, y, min(cell_w, rect.w - x), min(cell_h, rect.h - y)))
 
 
 class Vertical(View):
@@ -287,8 +658,8 @@ class Vertical(View):
   def size(self, rect):
     sizes = []
     for v in self.views:
-      sizes.append(v.size(rect))
-      rect = rect.adj_rect(0, sizes[-1][1])
+      sizes.append(v.measure(rect))
+      rect = rect.adj_rect(0, sizes[-1][1] + self.margin)
 
     widths = [s[0] for s in sizes]
     heights = [s[1] for s in sizes]
@@ -297,7 +668,7 @@ class Vertical(View):
   def disp(self, rect):
     for v in self.views:
       v.display(rect)
-      dy = v.size(rect)[1] + self.margin
+      dy = v.measure(rect)[1] + self.margin
       rect = rect.adj_rect(0, dy)
 
 
@@ -314,13 +685,13 @@ class Box(View):
 
   def size(self, rect):
     if not self.x_fill or not self.y_fill:
-      inner_size = self.inner.size(rect.adj_rect(1 + self.x_margin, 1 + self.y_margin, 1 + self.x_margin, 1 + self.y_margin))
+      inner_size = self.inner.measure(rect.adj_rect(1 + self.x_margin, 1 + self.y_margin, 1 + self.x_margin, 1 + self.y_margin))
     w = rect.w if self.x_fill else inner_size[0] + 2 * (1 + self.x_margin)
     h = rect.h if self.y_fill else inner_size[1] + 2 * (1 + self.y_margin)
     return w, h
 
   def disp(self, rect):
-    size = self.size(rect)
+    size = self.measure(rect)
 
     rect_w = min(size[0], rect.w)
     rect_h = min(size[1], rect.h)
@@ -335,11 +706,11 @@ class Box(View):
 
       try:
         rect.resize(rect_w, rect_h).clear()
-        textpad.rectangle(rect.screen, rect.y, rect.x, y1, x1)
+        rectangle(rect.screen, rect.y, rect.x, y1, x1)
         if self.caption:
           self.caption.display(rect.adj_rect(3, 0))
         if self.underscript:
-          s = self.underscript.size(rect)
+          s = self.underscript.measure(rect)
           self.underscript.display(rect.adj_rect(max(3, rect_w - s[0] - 3), rect_h - 1))
       except curses.error, e:
         # We should not have sent this invalid draw command...
@@ -351,6 +722,39 @@ class Box(View):
         logger.warn(e)
 
 
+class ControlView(View):
+  """A view that shows the most recent rendering of a control.
+
+  Controls embed these in their views instead of rendering their children
+  directly, so that a child that changed can be rendered and painted again
+  without touching the rest of the tree.
+  """
+  def __init__(self, control, app):
+    self.control = control
+    self.app = app
+
+  def size(self, rect):
+    return self.app.control_size(self.control, rect)
+
+  # Sizes of controls are already kept between frames
+  measure = size
+
+  def display(self, rect):
+    self.rect = rect
+    ctrl = self.control
+    view = self.app.current_view(ctrl)
+    # Not clipped: a child that grows beyond its rect must still be noticed
+    size = self.measure(rect)
+    if self.app.profiler:
+      self.app.profiled('disp', ctrl, view.display, rect)
+    else:
+      view.display(rect)
+    self.app.regions[ctrl] = (rect, size)
+    self.app.painted.add(ctrl)
+    if ctrl.volatile:
+      ctrl._mark_dirty()
+
+
 #----------------------------------------------------------------------
 #  CONTROL classes
 
@@ -364,7 +768,21 @@ class Control(object):
   - Put their children in the self.controls member, or override
     the children() method.
   - Override render() to return an instance of View.
+  - Use child.view(app) to include the View of a child control.
+
+  Controls are only rendered again after they have been invalidated. Assigning
+  to any attribute does that automatically; call invalidate() after changing
+  state in place (such as appending to self.controls).
   """
+  # Whether the control changed since it was last rendered
+  _dirty = True
+  # The App that last rendered this control
+  _app = None
+  # Whether render() depends on app.contains_focus(self)
+  _focus_dependent = False
+  # Volatile controls are rendered again on every frame
+  volatile = False
+
   def __init__(self, fg=white, bg=black, id=None):
     self.fg = fg
     self.bg = bg
@@ -372,9 +790,31 @@ class Control(object):
     self.can_focus = False
     self.controls = []
 
+  def __setattr__(self, name, value):
+    old = self.__dict__.get(name, self)
+    object.__setattr__(self, name, value)
+    # Assigning an equal number or string changes nothing. Other objects may
+    # have been changed in place, so assigning them again still counts.
+    if isinstance(value, IMMUTABLE_TYPES) and type(old) is type(value) and old == value:
+      return
+    self._mark_dirty()
+
+  def invalidate(self):
+    """Mark the control as changed, so it is painted again on the next frame."""
+    self._mark_dirty()
+
+  def _mark_dirty(self):
+    object.__setattr__(self, '_dirty', True)
+    if self._app:
+      self._app.dirty.add(self)
+
   def render(self, app):
     raise RuntimeError('Not implemented: render()')
 
+  def view(self, app):
+    """Return a View that shows this control, for use in a parent's View."""
+    return ControlView(self, app)
+
   def children(self):
     return self.controls
 
@@ -392,7 +832,11 @@ class Control(object):
     return False
 
   def find(self, id):
-    for parent, child in object_tree(self):
+    if self._app and (self in self._app.parents or self is self._app):
+      found = self._app.find_in(self, id)
+      if found:
+        return found
+    for parent, child in object_tree(self, self._app.profiler if self._app else None):
       if child.id == id:
         return child
     raise RuntimeError('No such control: %s' % id)
@@ -457,9 +901,12 @@ class Panel(Control):
     self.underscript = None
 
   def render(self, app):
-    return Box(Vertical([c.render(app) for c in self.controls]),
-               caption=self.caption.render(app) if self.caption else None,
-               underscript=self.underscript.render(app) if self.underscript else None)
+    return Box(Vertical([c.view(app) for c in self.controls]),
+               caption=self.caption.view(app) if self.caption else None,
+               underscript=self.underscript.view(app) if self.underscript else None)
+
+  def children(self):
+    return [c for c in [self.caption, self.underscript] if c] + self.controls
 
   def on_event(self, ev):
     propagate_focus(ev, self.controls, ev.app.layer(self),
@@ -474,7 +921,7 @@ class Stacked(Control):
     self.controls = controls
 
   def render(self, app):
-    return Vertical([c.render(app) for c in self.controls])
+    return Vertical([c.view(app) for c in self.controls])
 
   def on_event(self, ev):
     propagate_focus(ev, self.controls, ev.app.layer(self),
@@ -514,6 +961,31 @@ class Option(object):
     return 'Option(%r, %r)' % (self.value, self.caption)
 
 
+class RowSource(object):
+  """A sequence of rows that are only fetched when they are needed.
+
+  Pass this to a SelectList to show more rows than fit in memory.
+  `length()` returns the number of rows, `getitem(i)` the row at index i.
+  """
+  def __init__(self, length, getitem):
+    self.length = length
+    self.getitem = getitem
+
+  def __len__(self):
+    return self.length()
+
+  def __getitem__(self, i):
+    return self.getitem(i)
+
+
+def index_values(choices):
+  """Return a dict of value -> index for the given choices."""
+  index = {}
+  for i in xrange(len(choices)):
+    index.setdefault(get_value(choices[i]), i)
+  return index
+
+
 class Labeled(Control):
   """Applies an offset to a control, fill it with a text label."""
   def __init__(self, label, control, **kwargs):
@@ -526,12 +998,48 @@ class Labeled(Control):
     fg = white if app.contains_focus(self) else green
     attr = curses.A_BOLD if app.contains_focus(self) else 0
     return Horizontal([Display(self.label, min_width=16, fg=fg, attr=attr),
-                       self.control.render(app)])
+                       self.control.view(app)])
 
   def children(self):
     return [self.control]
 
 
+class ChoiceFilter(object):
+  """Finds the choices of a SelectList that contain some text, a chunk at a time.
+
+  Searches the given indexes of choices, or all choices if candidates is None.
+  """
+  chunk_size = 10000
+
+  def __init__(self, select, candidates, text):
+    self.select = select
+    self.candidates = candidates
+    self.text = text
+    self.matches = []     # Indexes of the matching choices found so far
+    self.pos = 0          # Position in the candidates to continue at
+    self.running = False  # Whether a task is continuing the search
+
+  @property
+  def total(self):
+    return len(self.select.choices) if self.candidates is None else len(self.candidates)
+
+  @property
+  def done(self):
+    return self.pos >= self.total
+
+  def step(self):
+    end = min(self.pos + self.chunk_size, self.total)
+    if self.candidates is None:
+      indexes = xrange(self.pos, end)
+      captions = self.select.captions_until(end)[self.pos:end]
+    else:
+      indexes = self.candidates[self.pos:end]
+      captions = itertools.imap(self.select.captions.__getitem__, indexes)
+    self.matches.extend(itertools.compress(
+        indexes, itertools.imap(operator.contains, captions, itertools.repeat(self.text))))
+    self.pos = end
+
+
 class SelectList(Control):
   """Selection list.
 
@@ -539,10 +1047,20 @@ class SelectList(Control):
   change the selection.
 
   The `selectList.value` property contains the selected value.
+
+  `choices` can be any sequence that supports len() and indexing, such as a
+  RowSource. Only the visible rows are fetched. Looking up a value searches
+  through the choices, unless a dict of value -> index is given as
+  `value_index` (see index_values()).
+
+  Type '/' and then some text to only show the choices that contain that
+  text. While a filter is active, `index` is the position among the matching
+  choices; `choice_index` is the index in `choices`.
   """
-  def __init__(self, choices, index=0, width=30, height=10, show_captions_at=0, **kwargs):
+  def __init__(self, choices, index=0, width=30, height=10, show_captions_at=0, value_index=None, **kwargs):
     super(SelectList, self).__init__(**kwargs)
     self.choices = choices
+    self.value_index = value_index
     self.index = index
     self.width = width
     self.height = height
@@ -550,21 +1068,51 @@ class SelectList(Control):
     self.can_focus = True
     self.show_captions_at = show_captions_at
 
+    self.filter = ''           # Lowercase text that shown choices contain
+    self.filtering = False     # Whether typed keys go to the filter
+    self.scan = None           # ChoiceFilter for the filter, if any
+    self.filter_history = []   # Previous ChoiceFilters, to go back to on backspace
+    self.captions = []         # Lowercase captions of the first choices
+    self.indexed = None        # The choices that the captions are for
+
+  @property
+  def matches(self):
+    """Indexes of the choices that match the filter, or None."""
+    return self.scan.matches if self.scan else None
+
+  @property
+  def row_count(self):
+    """Number of choices that are shown."""
+    return len(self.matches) if self.matches is not None else len(self.choices)
+
+  def row(self, i):
+    return self.choices[self.matches[i] if self.matches is not None else i]
+
+  @property
+  def choice_index(self):
+    """Index of the selected value in choices, or None if nothing matches the filter."""
+    if self.matches is not None:
+      return self.matches[self.index] if self.matches else None
+    return self.index
+
   def adjust(self, d):
     """Scroll by the given delta through the options."""
-    if len(self.choices) > 1:
-      self.index = (self.index + d + len(self.choices)) % len(self.choices)
+    count = self.row_count
+    if count > 1:
+      self.index = (self.index + d + count) % count
       self.scroll_offset = min(self.scroll_offset, self.index)
       self.scroll_offset = max(self.scroll_offset, self.index - self.height + 1)
 
   def sanitize_index(self):
-    self.index = min(max(0, self.index), len(self.choices) - 1)
-    return 0 <= self.index < len(self.choices)
+    self.index = min(max(0, self.index), self.row_count - 1)
+    return 0 <= self.index < self.row_count
 
   @property
   def value(self):
     """Return the currently selected value."""
-    return get_value(self.choices[self.index])
+    if self.choice_index is None:
+      return None
+    return get_value(self.choices[self.choice_index])
 
   @value.setter
   def value(self, value):
@@ -572,7 +1120,69 @@ class SelectList(Control):
 
     Reset to 0 if not in the list.
     """
-    self.index = max(0, self.choices.index(value))
+    if self.value_index is not None:
+      self.select_choice(self.value_index.get(value, 0))
+    else:
+      self.select_choice(next((i for i in xrange(len(self.choices))
+                               if get_value(self.choices[i]) == value), 0))
+
+  def select_choice(self, i):
+    """Select choices[i], or the first row if it is filtered out."""
+    if self.matches is not None:
+      pos = bisect.bisect_left(self.matches, i)
+      i = pos if pos < len(self.matches) and self.matches[pos] == i else 0
+    self.index = i
+    self.scroll_offset = min(self.scroll_offset, self.index)
+    self.scroll_offset = max(0, self.scroll_offset, self.index - self.height + 1)
+
+  def set_filter(self, text):
+    """Only show the choices whose caption contains text (ignoring case).
+
+    Typing more text only searches through the previous matches. On big lists,
+    the search continues in between frames.
+    """
+    text = text.lower()
+    selected = (self.choice_index if self.row_count else None) or 0
+    if self.indexed is not self.choices:
+      # The choices were replaced
+      self.captions = []
+      self.indexed = self.choices
+      self.scan = None
+
+    if not text:
+      self.filter_history = []
+      self.scan = None
+    elif self.filter_history and self.filter_history[-1].text == text:
+      self.scan = self.filter_history.pop()
+    elif self.scan and text.startswith(self.scan.text):
+      self.filter_history.append(self.scan)
+      self.scan = ChoiceFilter(self, self.scan.matches if self.scan.done else self.scan.candidates, text)
+    else:
+      self.filter_history = []
+      self.scan = ChoiceFilter(self, None, text)
+    self.filter = text
+
+    if self.scan:
+      scan = self.scan
+      run_steps(self, scan, lambda: scan is self.scan)
+    self.select_choice(selected)
+
+  def captions_until(self, end):
+    """Return the lowercase captions, indexed at least up to end."""
+    for i in xrange(len(self.captions), end):
+      self.captions.append(str(self.choices[i]).lower())
+    return self.captions
+
+  def _display_match(self, text, min_width, attr, fg=white):
+    """Display text, highlighting where the filter matches it."""
+    at = text.lower().find(self.filter) if self.filter else -1
+    if at == -1:
+      return Display(text, min_width=min_width, attr=attr, fg=fg)
+    end = at + len(self.filter)
+    styled = (StyledText(text[:at])
+              .append(text[at:end], fg=yellow, attr=curses.A_UNDERLINE)
+              .append(text[end:]))
+    return Display(styled, min_width=min_width, attr=attr, fg=fg)
 
   def _render_line(self, line, selected):
     attr = curses.A_STANDOUT if selected else 0
@@ -580,27 +1190,71 @@ class SelectList(Control):
       rem = self.width - self.show_captions_at
       return Horizontal([
           Display(str(line.value)[:self.show_captions_at], min_width=self.show_captions_at, attr=attr),
-          Display(str(line.caption)[:rem], min_width=rem, attr=attr, fg=cyan if not selected else white)
+          self._display_match(str(line.caption)[:rem], rem, attr, fg=cyan if not selected else white)
           ])
-    return Display(line, min_width=self.width, attr=attr)
+    return self._display_match(str(line), self.width, attr)
 
   def render(self, app):
+    if self.scan and self.indexed is not self.choices:
+      # The choices were replaced
+      self.set_filter(self.filter)
     self.sanitize_index()
 
-    lines = self.choices[self.scroll_offset:self.scroll_offset + self.height]
+    end = min(self.row_count, self.scroll_offset + self.height)
+    lines = [self.row(i) for i in xrange(self.scroll_offset, end)]
     lines.extend([''] * (self.height - len(lines)))
 
     self.last_render = Vertical([self._render_line(l, i + self.scroll_offset == self.index) for i, l in enumerate(lines)])
 
     # FIXME: Scroll bar
+    if self.filtering or self.filter:
+      status = '/' + self.filter + ('_' if self.filtering else '')
+      if self.scan and not self.scan.done:
+        status += ' ...'
+      return Vertical([self.last_render, Display(status, min_width=self.width, fg=yellow)])
     return self.last_render
 
   def on_event(self, ev):
     if ev.type == 'key':
-      change, self.index, self.scroll_offset = handle_scroll_key(ev.key, self.index, len(self.choices), self.scroll_offset, self.last_render.rect.h)
+      if self._filter_key(ev):
+        ev.stop()
+        return
+      if is_enter(ev) and self.choice_index is None:
+        # Nothing to select
+        ev.stop()
+        return
+      change, self.index, self.scroll_offset = handle_scroll_key(ev.key, self.index, self.row_count, self.scroll_offset, self.last_render.rect.h)
       if change:
         ev.stop()
 
+  def _filter_key(self, ev):
+    """Handle a key for the filter, returning whether it was used."""
+    if not self.filtering:
+      if ev.key == ord('/'):
+        self.filtering = True
+        return True
+      if ev.key == curses.ascii.ESC and self.filter:
+        self.set_filter('')
+        return True
+      return False
+
+    if 32 <= ev.key < 127:
+      self.set_filter(self.filter + chr(ev.key))
+    elif ev.key in [curses.KEY_BACKSPACE, MAC_BACKSPACE]:
+      if self.filter:
+        self.set_filter(self.filter[:-1])
+      else:
+        self.filtering = False
+    elif ev.key == curses.ascii.ESC:
+      self.filtering = False
+      self.set_filter('')
+    else:
+      # Stop typing, but let Enter select
+      if is_enter(ev):
+        self.filtering = False
+      return False
+    return True
+
 
 class SelectDate(Control):
   """A Calendar control for selecting a date.
@@ -609,7 +1263,7 @@ class SelectDate(Control):
   `.date` contains the date date as a datetime.date.
   """
   def __init__(self, value=None, **kwargs):
-    super(Control, self).__init__(**kwargs)
+    super(SelectDate, self).__init__(**kwargs)
     self.can_focus = True
     self.value = value or datetime.datetime.now()
     self.controls = []
@@ -669,7 +1323,7 @@ class Composite(Control):
 
   def render(self, app):
     m = Display(' ' * self.margin)
-    xs = [c.render(app) for c in self.controls]
+    xs = [c.view(app) for c in self.controls]
     rendered = list(itertools.chain(*list(zip(xs, itertools.repeat(m)))))
     return Horizontal(rendered)
 
@@ -704,7 +1358,7 @@ class Popup(Control):
     self.underscript = underscript
 
   def render(self, app):
-    inner = Box(self.inner.render(app),
+    inner = Box(self.inner.view(app),
                 x_fill=False,
                 caption=Display(self.caption),
                 underscript=Display(self.underscript))
@@ -735,23 +1389,96 @@ def EditPopup(app, on_close, value='', caption=''):
 
 
 class Combo(Control):
-  """A SelectList in a popup."""
-  def __init__(self, choices, index=0, **kwargs):
+  """A SelectList in a popup.
+
+  choices can also be a function that returns the choices. It is called
+  again after invalidate(), or when the choices are older than ttl seconds.
+  With background=True, that happens on a worker thread, and the old choices
+  are shown until the new ones are in.
+  """
+  def __init__(self, choices, index=0, ttl=None, background=False, **kwargs):
     super(Combo, self).__init__(**kwargs)
     self._choices = choices
     self.index = index
+    self.ttl = ttl
+    self.background = background
     self.can_focus = True
     self.last_combo = None
+    self.cached = None      # The choices, if they were fetched already
+    self.fetched_at = None  # When the choices were fetched
+    self.stale = False      # Whether the choices must be fetched again
+    self.loading = False    # Whether the choices are being fetched in the background
+    self.expiry = None      # Timer for the ttl
+    self._values = None     # Value -> index in the choices
+
+  def invalidate(self):
+    """Paint the combo again, and get the choices again if they come from a function."""
+    self.stale = True
+    self._values = None
+    super(Combo, self).invalidate()
 
   def sanitize_index(self):
-    self.index = min(max(0, self.index), len(self.choices) - 1)
-    return 0 <= self.index < len(self.choices)
+    choices = self.choices
+    self.index = min(max(0, self.index), len(choices) - 1)
+    return 0 <= self.index < len(choices)
 
   @property
   def choices(self):
-    if callable(self._choices):
-      return self._choices()
-    return self._choices
+    if not callable(self._choices):
+      return self._choices
+
+    expired = self.ttl is not None and self.fetched_at is not None and monotonic() - self.fetched_at >= self.ttl
+    if self.cached is None:
+      self._store(self._choices())
+    elif (self.stale or expired) and not self.loading:
+      if self.background and self._app:
+        self.loading = True
+        self._app.run_in_background(self._choices, on_done=self._loaded, on_error=self._failed)
+      else:
+        self._store(self._choices())
+    return self.cached
+
+  @property
+  def values(self):
+    """Return a dict of value -> index in the choices."""
+    choices = self.choices
+    if self._values is None:
+      self._values = index_values(choices)
+    return self._values
+
+  def _store(self, choices):
+    value = get_value(self.cached[self.index]) if self.cached and 0 <= self.index < len(self.cached) else None
+    self.cached = choices
+    self.fetched_at = monotonic()
+    self.stale = False
+    self._values = None
+    if value is not None:
+      # Keep the same value selected
+      self.index = self.values.get(value, self.index)
+    if self.expiry:
+      self.expiry.cancel()
+      self.expiry = None
+    if self._app:
+      self._schedule_expiry(self._app)
+
+  def _schedule_expiry(self, app):
+    # Choices fetched before we were on screen are timed from when they were fetched
+    if self.ttl is not None and self.fetched_at is not None:
+      left = max(0, self.fetched_at + self.ttl - monotonic())
+      self.expiry = app.enqueue(left, lambda app: self._expire())
+
+  def _expire(self):
+    self.expiry = None
+    self.invalidate()
+
+  def _loaded(self, app, choices):
+    self.loading = False
+    self._store(choices)
+
+  def _failed(self, app, e):
+    # Keep showing the old choices
+    self.loading = False
+    logger.error(str(e))
 
   @property
   def value(self):
@@ -761,10 +1488,7 @@ class Combo(Control):
 
   @value.setter
   def value(self, value):
-    try:
-      self.index = max(0, self.choices.index(value))
-    except ValueError:
-      self.index = 0
+    self.index = self.values.get(value, 0)
 
   @property
   def caption(self):
@@ -775,6 +1499,8 @@ class Combo(Control):
   def render(self, app):
     attr = curses.A_STANDOUT if app.contains_focus(self) else 0
     self.last_combo = Display(self.caption, attr=attr)
+    if self.expiry is None:
+      self._schedule_expiry(app)
     return self.last_combo
 
   def on_event(self, ev):
@@ -782,11 +1508,118 @@ class Combo(Control):
       if is_enter(ev):
         x = max(0, self.last_combo.rect.x - 2)
         y = max(0, self.last_combo.rect.y - 1)
-        Popup(SelectList(self.choices, self.index), self.on_popup_close, x=x, y=y).show(ev.app)
+        select = SelectList(self.choices, self.index, value_index=self.values)
+        Popup(select, self.on_popup_close, x=x, y=y).show(ev.app)
         ev.stop()
 
   def on_popup_close(self, popup, app):
-    self.index = popup.inner.index
+    if popup.inner.choice_index is not None:
+      self.index = popup.inner.choice_index
+
+
+class Profiler(object):
+  """Times the work done for every control, and counts the work per frame.
+
+  Turn it on with app.profile(). Time is kept per (what, control class, id),
+  where what is 'render', 'size', 'disp' or 'on_event'. The total time of
+  size, disp and on_event includes the time of child controls; the self
+  time does not. Per frame, it counts object_tree() walks and curses calls.
+  """
+  history = 120  # Number of frames to keep counts for
+
+  def __init__(self):
+    self.entries = {}  # (what, class name, id) -> [calls, total, self, max]
+    self.stack = []    # [key, start, time spent in nested calls]
+    self.frames = collections.deque(maxlen=self.history)
+    self.counts = collections.Counter()  # Of the frame that is being drawn
+    self.frame_start = None
+
+  def begin(self, what, ctrl):
+    self.stack.append([(what, type(ctrl).__name__, ctrl.id), monotonic(), 0.0])
+
+  def end(self):
+    key, start, nested = self.stack.pop()
+    elapsed = monotonic() - start
+    if self.stack:
+      self.stack[-1][2] += elapsed
+    entry = self.entries.get(key)
+    if entry is None:
+      entry = self.entries[key] = [0, 0.0, 0.0, 0.0]
+    entry[0] += 1
+    entry[1] += elapsed
+    entry[2] += elapsed - nested
+    entry[3] = max(entry[3], elapsed)
+
+  def count(self, what):
+    self.counts[what] += 1
+
+  def start_frame(self):
+    self.frame_start = monotonic()
+
+  def end_frame(self):
+    if self.frame_start is None:
+      # Profiling started during the frame
+      return
+    frame = dict(self.counts)
+    frame['ms'] = (monotonic() - self.frame_start) * 1000
+    self.frames.append(frame)
+    self.counts = collections.Counter()
+
+  def reset(self):
+    self.entries = {}
+    self.frames.clear()
+
+  def stats(self):
+    """Return the results as plain data, slowest controls first."""
+    ms = lambda seconds: round(seconds * 1000, 3)
+    frames = list(self.frames)
+    average = lambda what: round(sum(f.get(what, 0) for f in frames) / float(len(frames)), 2) if frames else 0
+    controls = [{'what': what, 'control': name, 'id': id, 'calls': calls,
+                 'total_ms': ms(total), 'self_ms': ms(own), 'max_ms': ms(longest)}
+                for (what, name, id), (calls, total, own, longest) in self.entries.items()]
+    controls.sort(key=lambda c: c['self_ms'], reverse=True)
+    return {
+        'frames': len(frames),
+        'frame_ms': {'last': round(frames[-1]['ms'], 3) if frames else 0,
+                     'mean': average('ms'),
+                     'max': round(max(f['ms'] for f in frames), 3) if frames else 0},
+        'per_frame': {'object_tree': average('object_tree'), 'curses_calls': average('curses_calls')},
+        'controls': controls,
+        }
+
+
+class StatsOverlay(Control):
+  """Shows the stats of the app's profiler, in the corner of the screen."""
+  def __init__(self, **kwargs):
+    super(StatsOverlay, self).__init__(**kwargs)
+    self.controls = [StatsBox()]
+
+  def render(self, app):
+    return AlignRight(self.controls[0].view(app))
+
+
+class StatsBox(Control):
+  """The box with the stats in a StatsOverlay.
+
+  It keeps the same size, so that only the box is painted again every frame,
+  and not the layers below it.
+  """
+  volatile = True  # The stats change with every frame
+  rows = 8         # Number of controls to show
+  width = 60       # Of the text in the box
+
+  def render(self, app):
+    stats = app.stats()
+    lines = ['Not profiling']
+    if stats:
+      lines = ['frame %(last).1fms  mean %(mean).1fms  max %(max).1fms' % stats['frame_ms'],
+               'per frame: %(object_tree)s tree walks, %(curses_calls)s curses calls' % stats['per_frame'],
+               '']
+      for c in stats['controls'][:self.rows]:
+        name = c['control'] + ('#' + str(c['id']) if c['id'] is not None else '')
+        lines.append('%9.2fms %6d  %-8s %s' % (c['self_ms'], c['calls'], c['what'], name))
+    lines = [l[:self.width] for l in lines] + [''] * (self.rows + 3 - len(lines))
+    return Box(Display(lines, fg=cyan, min_width=self.width), x_fill=False, caption=Display('Profile'))
 
 
 class Toasty(Control):
@@ -864,13 +1697,118 @@ class Time(Composite):
     return datetime.time(int(self.hour_combo.value), int(self.min_combo.value))
 
 
+def common_prefix_length(a, b):
+  lo, hi = 0, min(len(a), len(b))
+  while lo < hi:
+    mid = (lo + hi + 1) // 2
+    if a[lo:mid] == b[lo:mid]:
+      lo = mid
+    else:
+      hi = mid - 1
+  return lo
+
+
+def common_suffix_length(a, b, limit):
+  """Length of the common end of a and b, but at most limit."""
+  lo, hi = 0, min(len(a), len(b), limit)
+  while lo < hi:
+    mid = (lo + hi + 1) // 2
+    if a[len(a) - mid:len(a) - lo] == b[len(b) - mid:len(b) - lo]:
+      lo = mid
+    else:
+      hi = mid - 1
+  return lo
+
+
+class RegexHighlighter(object):
+  """Syntax highlighter for Edit, made out of regexes.
+
+  rules maps lexer states to lists of (regex, fg, [attr], [next_state])
+  rules, or is a single list of rules. Lexing starts in state 'root', and
+  text that no rule matches is not highlighted. A rule with fg None only
+  changes the state.
+
+  The highlighter remembers the state after every token of the last text.
+  When the text changes, it lexes again from the last token before the
+  change, until it is back in step with the old tokens.
+  """
+  def __init__(self, rules):
+    if not isinstance(rules, dict):
+      rules = {'root': rules}
+    self.rules = {}
+    for state, state_rules in rules.iteritems():
+      state_rules = [tuple(r) + (0, None)[len(r) - 2:] for r in state_rules]
+      regex = re.compile('|'.join('(?P<r%d>%s)' % (i, r[0]) for i, r in enumerate(state_rules)))
+      self.rules[state] = (regex, [r[1:] for r in state_rules])
+    self.text = None
+    self.tokens = []                 # (start, end, fg, attr) for every token
+    self.ends = array.array('L')     # End of every token
+    self.states = []                 # State after every token
+
+  def __call__(self, text):
+    styled = StyledText()
+    at = 0
+    for start, end, fg, attr in self.lex(text):
+      if fg is not None:
+        styled.append(text[at:start])
+        styled.append(text[start:end], fg, attr=attr)
+        at = end
+    return styled.append(text[at:])
+
+  def lex(self, text):
+    """Return the (start, end, fg, attr) tokens of text."""
+    if text == self.text:
+      return self.tokens
+
+    old_text = self.text or ''
+    old_tokens, old_ends, old_states = self.tokens, self.ends, self.states
+    prefix = common_prefix_length(old_text, text) if self.text is not None else 0
+    suffix = common_suffix_length(old_text, text, min(len(old_text), len(text)) - prefix)
+    delta = len(text) - len(old_text)
+
+    # Keep the tokens that end before the change, a token that ends at the
+    # change could get longer.
+    n = bisect.bisect_left(old_ends, prefix)
+    self.text = text
+    self.tokens = old_tokens[:n]
+    self.ends = old_ends[:n]
+    self.states = old_states[:n]
+    pos, state = (old_ends[n - 1], old_states[n - 1]) if n else (0, 'root')
+
+    while True:
+      regex, styles = self.rules[state]
+      match = regex.search(text, pos)
+      while match and match.end() == match.start():
+        match = regex.search(text, match.start() + 1)
+      if not match:
+        return self.tokens
+
+      fg, attr, next_state = styles[int(match.lastgroup[1:])]
+      pos = match.end()
+      state = next_state or state
+      self.tokens.append((match.start(), pos, fg, attr))
+      self.ends.append(pos)
+      self.states.append(state)
+
+      if pos >= len(text) - suffix and old_tokens:
+        # In the unchanged part; once in the same state as before, the rest is the same
+        i = bisect.bisect_left(old_ends, pos - delta)
+        if i < len(old_ends) and old_ends[i] == pos - delta and old_states[i] == state:
+          self.tokens.extend((start + delta, end + delta, fg, attr)
+                             for start, end, fg, attr in old_tokens[i + 1:])
+          self.ends.extend(end + delta for end in old_ends[i + 1:])
+          self.states.extend(old_states[i + 1:])
+          return self.tokens
+
+
 class Edit(Control):
   """Standard text edit control.
 
   Arguments:
-    highlight, fn: a syntax highlighting function. Will be given a string, and
-      should return a list of curses (color, attributes), one for every
-      character.
+    highlight, fn: a syntax highlighting function, such as a RegexHighlighter.
+      Will be given a string, and should return StyledText (or the string
+      with the highlighted parts replaced by str(Colorized(...))). It is only
+      called again when the value changes.
   """
   def __init__(self, value, min_size=0, highlight=None, **kwargs):
     super(Edit, self).__init__(**kwargs)
@@ -879,6 +1817,7 @@ class Edit(Control):
     self.can_focus = True
     self.cursor = len(value)
     self.highlight = highlight
+    self.highlighted = None  # (value, StyledText of the value)
 
   @property
   def value(self):
@@ -889,61 +1828,35 @@ class Edit(Control):
     self._value = value
     self.cursor = len(value)
 
+  def styled_value(self):
+    """Return the value as StyledText, highlighted if there is a highlight function."""
+    if not self.highlight:
+      return StyledText(self.value)
+    if self.highlighted and self.highlighted[0] == self.value:
+      return self.highlighted[1]
+
+    try:
+      styled = self.highlight(self.value)
+      if not isinstance(styled, StyledText):
+        styled = StyledText.decode(str(styled))
+    except Exception, e:
+      logger.error(str(e))
+      styled = StyledText(self.value)
+    self.highlighted = (self.value, styled)
+    return styled
+
   def render(self, app):
     focused = app.contains_focus(self)
-
-    # Default highlighting, foreground color
-    colorized = self.value
-    if self.highlight:
-      # Custom highlighting
-      try:
-        colorized = self.highlight(self.value)
-      except Exception, e:
-        logger.error(str(e))
+    styled = self.styled_value()
 
     # Make the field longer for the cursor or display purposes
-    ext_len = max(0, max(self.cursor + 1 if focused else 0, self.min_size) - len(self.value))
-    colorized += ' ' * ext_len
+    width = max(len(styled), self.cursor + 1 if focused else 0, self.min_size)
 
-    # Render that momma
-    self.rendered = Horizontal(self._render_colorized(colorized, focused))
+    self.rendered = Display(styled, min_width=width, fg=self.fg,
+                            attr=curses.A_UNDERLINE if focused else 0,
+                            cursor=(self.cursor, 0) if focused else None)
     return self.rendered
 
-  def _render_colorized(self, colorized, focused):
-    """Split a colorized string into Display() slices."""
-    base_attr = 0
-    if focused:
-      base_attr = curses.A_UNDERLINE
-
-    frag_list = []
-    parts = colorized.split('\0')
-    chars_so_far = 0
-    for i in range(0, len(parts), 2):
-      # i is regular, i+1 is colorized (if it's there)
-      frag_list.append(Display(parts[i], fg=self.fg, attr=base_attr))
-      if focused:
-        chars_so_far = self._inject_cursor(chars_so_far, frag_list)
-
-      if i + 1 < len(parts):
-        color, attr, text = parts[i+1].split('\1')
-        frag_list.append(Display(text, fg=int(color), attr=base_attr+int(attr)))
-        if focused:
-          chars_so_far = self._inject_cursor(chars_so_far, frag_list)
-
-    return frag_list
-
-  def _inject_cursor(self, chars_so_far, frag_list):
-    """If the cursor falls into this fragment, highlight it."""
-    last = frag_list[-1]
-    if chars_so_far <= self.cursor < chars_so_far + len(last.text):
-      offset = self.cursor - chars_so_far
-      pre, hi, post = last.text[:offset], last.text[offset], last.text[offset+1:]
-      frag_list[-1:] = [Display(pre, fg=last.fg, attr=last.attr),
-                        Display(hi, fg=last.fg, attr=last.attr + curses.A_STANDOUT),
-                        Display(post, fg=last.fg, attr=last.attr)]
-
-    return chars_so_far + len(last.text)
-
   def on_event(self, ev):
     if ev.type == 'key':
       if ev.key in [CTRL_A, curses.KEY_HOME]:
@@ -975,6 +1888,116 @@ class Edit(Control):
         self._value = self._value[:self.cursor] + chr(ev.key) + self._value[self.cursor:]
         self.cursor += 1
         ev.stop()
+    if ev.type == 'paste':
+      # Single line, so lines are joined
+      text = ''.join(c for c in ev.what.replace('\n', ' ') if ' ' <= c != '\x7f')
+      self._value = self._value[:self.cursor] + text + self._value[self.cursor:]
+      self.cursor += len(text)
+      ev.stop()
+
+
+def next_string(prefix):
+  """Return the first string after all strings that start with prefix."""
+  i = len(prefix)
+  while i > 0 and ord(prefix[i-1]) == (0xff if isinstance(prefix, str) else 0x10ffff):
+    i -= 1
+  if i == 0:
+    return None
+  bump = chr if isinstance(prefix, str) else unichr
+  return prefix[:i-1] + bump(ord(prefix[i-1]) + 1)
+
+
+class Completer(object):
+  """Completes words from a vocabulary, to use as complete_fn of AutoCompleteEdit.
+
+  The words are kept in a sorted list, so the words that start with a prefix
+  are found with a binary search. With fuzzy=True, words that contain the
+  letters in order also match, best matches first; like regex search, this
+  ignores case if the word has no capitals. limit is the maximum number of
+  completions to return.
+
+  Prefix lookups are fast enough to do on the UI thread, so use it with
+  background=False and delay=0. Fuzzy lookups go through all words if only a
+  few start with the typed word, so keep those in the background for big
+  vocabularies. Without fuzzy or limit, pass narrow=prefix_completions too.
+  """
+  def __init__(self, words=(), fuzzy=False, limit=None):
+    self.words = sorted(set(words))
+    self.fuzzy = fuzzy
+    self.limit = limit
+    self.joined = None  # All words on separate lines, for fuzzy searches
+    self.folded = None  # Same, in lowercase
+
+  def __len__(self):
+    return len(self.words)
+
+  def __contains__(self, word):
+    i = bisect.bisect_left(self.words, word)
+    return i < len(self.words) and self.words[i] == word
+
+  def add(self, word):
+    i = bisect.bisect_left(self.words, word)
+    if i == len(self.words) or self.words[i] != word:
+      self.words.insert(i, word)
+      self.joined = self.folded = None
+
+  def remove(self, word):
+    i = bisect.bisect_left(self.words, word)
+    if i < len(self.words) and self.words[i] == word:
+      del self.words[i]
+      self.joined = self.folded = None
+
+  def prefixed(self, prefix, limit=None):
+    """Return the words that start with prefix, in order."""
+    lo = bisect.bisect_left(self.words, prefix)
+    end = next_string(prefix)
+    hi = bisect.bisect_left(self.words, end, lo) if end is not None else len(self.words)
+    if limit is not None:
+      hi = min(hi, lo + limit)
+    return self.words[lo:hi]
+
+  def matching(self, word):
+    """Return the words that contain the letters of word in order, best first.
+
+    Words that start with word come first, then the ones that have the
+    letters closest together, then shorter ones. The whole vocabulary is only
+    searched if not enough words start with word.
+    """
+    prefixed = self.prefixed(word)
+    if self.limit is not None and len(prefixed) >= self.limit:
+      # They're in alphabetical order already, and nsmallest keeps that order for ties
+      return heapq.nsmallest(self.limit, prefixed, key=len)
+
+    if self.joined is None:
+      self.joined = '\n'.join(self.words)
+      self.folded = self.joined.lower()
+    # Searching in lowercase text is a lot faster than re.IGNORECASE
+    text = self.folded if word == word.lower() else self.joined
+    # Every letter matches where it first occurs after the previous one
+    regex = re.compile(re.escape(word[0]) + ''.join('[^\n%s]*%s' % (re.escape(c), re.escape(c))
+                                                    for c in word[1:]))
+
+    ranked = []
+    match = regex.search(text)
+    while match:
+      line_start = text.rfind('\n', 0, match.start()) + 1
+      line_end = text.find('\n', match.end())
+      if line_end == -1:
+        line_end = len(text)
+      ranked.append((match.start() > line_start, match.end() - match.start(),
+                     line_end - line_start, self.joined[line_start:line_end]))
+      match = regex.search(text, line_end)
+
+    if self.limit is not None:
+      ranked = heapq.nsmallest(self.limit, ranked)
+    else:
+      ranked.sort()
+    return [r[-1] for r in ranked]
+
+  def __call__(self, word):
+    if self.fuzzy and word:
+      return self.matching(word)
+    return self.prefixed(word, self.limit)
 
 
 class AutoCompleteEdit(Edit):
@@ -982,8 +2005,17 @@ class AutoCompleteEdit(Edit):
 
   complete_fn is a function that gets the current word under
   the cursor, and should return all possible completions.
+
+  complete_fn is called on a worker thread (unless background=False), once
+  typing has paused for delay seconds. Results for the most recent words are
+  cached. To also find the completions for a longer word by narrowing down
+  the cached ones, pass a function narrow(word, completions). If complete_fn
+  returns all completions that start with the word, prefix_completions does.
   """
-  def __init__(self, value, complete_fn, min_size=0, letters=string.letters, **kwargs):
+  cache_size = 32  # Number of words to remember completions for
+
+  def __init__(self, value, complete_fn, min_size=0, letters=string.letters,
+               delay=0.1, background=True, narrow=None, **kwargs):
     super(AutoCompleteEdit, self).__init__(value=value, min_size=min_size, **kwargs)
     self.complete_fn = complete_fn
     self.popup_visible = False
@@ -991,6 +2023,12 @@ class AutoCompleteEdit(Edit):
     self.popup = Popup(self.select, on_close=self.on_close, underscript='( ^N, ^P to move, Enter to select )')
     self.layer = None
     self.letters = letters
+    self.delay = delay
+    self.background = background
+    self.narrow = narrow
+    self.word = None    # The word that completions were last asked for
+    self.timer = None   # Pending completion request
+    self.completions = collections.OrderedDict()  # Word -> completions, oldest first
 
   def on_close(self):
     pass
@@ -1026,16 +2064,72 @@ class AutoCompleteEdit(Edit):
     i, current = self.cursor_word
     self.value = self.value[:i] + word + self.value[i+len(current):]
 
+  def cached_completions(self, word):
+    """Return the completions for word from the cache, or None."""
+    if word in self.completions:
+      completions = self.completions.pop(word)
+    elif self.narrow:
+      prefix = next((word[:i] for i in xrange(len(word) - 1, -1, -1)
+                     if word[:i] in self.completions), None)
+      if prefix is None:
+        return None
+      completions = self.narrow(word, self.completions[prefix])
+    else:
+      return None
+    self.remember_completions(word, completions)
+    return completions
+
+  def remember_completions(self, word, completions):
+    self.completions.pop(word, None)
+    self.completions[word] = completions
+    while len(self.completions) > self.cache_size:
+      self.completions.popitem(last=False)
+
+  def request_completions(self, app, word):
+    """Show the completions for word, once they are known.
+
+    Requests for words that are no longer under the cursor are dropped.
+    """
+    self.cancel_completions()
+    self.word = word
+    completions = self.cached_completions(word)
+    if completions is not None:
+      self.show_completions(app, word, completions)
+    else:
+      self.timer = app.enqueue(self.delay, lambda app: self._complete(app, word))
+
+  def cancel_completions(self):
+    if self.timer:
+      self.timer.cancel()
+      self.timer = None
+    self.word = None
+
+  def _complete(self, app, word):
+    self.timer = None
+    if self.background:
+      app.run_in_background(self.complete_fn, args=(word,),
+                            on_done=lambda app, completions: self._completed(app, word, completions))
+    else:
+      self._completed(app, word, self.complete_fn(word))
+
+  def _completed(self, app, word, completions):
+    self.remember_completions(word, completions)
+    if word == self.word:
+      self.show_completions(app, word, completions)
+
+  def show_completions(self, app, word, completions):
+    """Put the completions in the popup, which is only shown if they're useful."""
+    if completions is not self.select.choices:
+      self.set_autocomplete_options(completions)
+    interesting = (len(completions) > 1
+                   or (len(completions) == 1 and completions[0] != word))
+    self.show_popup(app, interesting and app.contains_focus(self))
+
   def on_event(self, ev):
     super(AutoCompleteEdit, self).on_event(ev)
 
-    if ev.app.contains_focus(self):
-      _, word = self.cursor_word
-      self.set_autocomplete_options(self.complete_fn(word))
-      interesting = (len(self.select.choices) > 1
-                     or (len(self.select.choices) == 1) and self.select.choices[0] != word)
-      self.show_popup(ev.app, interesting)
     if ev.type == 'blur':
+      self.cancel_completions()
       self.show_popup(ev.app, False)
 
     if ev.type == 'key' and self.layer:
@@ -1048,11 +2142,351 @@ class AutoCompleteEdit(Edit):
       if is_enter(ev):
         self.replace_cursor_word(self.select.value)
         self.show_popup(ev.app, False)
+        self.cancel_completions()
+        self.word = self.cursor_word[1]
         ev.stop()
       if ev.key in [curses.ascii.ESC]:
         self.show_popup(ev.app, False)
         ev.stop()
 
+    # Only look for completions when the word under the cursor changes
+    if ev.type in ['key', 'paste'] and ev.app.contains_focus(self):
+      _, word = self.cursor_word
+      if word != self.word:
+        self.request_completions(ev.app, word)
+
+
+class RopeNode(object):
+  """A chunk of text in a Rope, with the size and newlines of its subtree."""
+  __slots__ = ['text', 'newlines', 'priority', 'left', 'right', 'size', 'lines']
+
+  def __init__(self, text):
+    self.text = text
+    self.newlines = text.count('\n')
+    self.priority = random.random()
+    self.left = None
+    self.right = None
+    self.size = len(text)
+    self.lines = self.newlines
+
+
+def node_size(node):
+  return node.size if node else 0
+
+
+def node_lines(node):
+  return node.lines if node else 0
+
+
+def update_node(node):
+  node.size = len(node.text) + node_size(node.left) + node_size(node.right)
+  node.lines = node.newlines + node_lines(node.left) + node_lines(node.right)
+  return node
+
+
+def split_nodes(node, pos):
+  """Split a tree of nodes into trees for the text before and after pos."""
+  if node is None:
+    return None, None
+  left_size = node_size(node.left)
+  if pos <= left_size:
+    before, node.left = split_nodes(node.left, pos)
+    return before, update_node(node)
+  pos -= left_size
+  if pos >= len(node.text):
+    node.right, after = split_nodes(node.right, pos - len(node.text))
+    return update_node(node), after
+
+  tail = RopeNode(node.text[pos:])
+  node.text = node.text[:pos]
+  node.newlines = node.text.count('\n')
+  right, node.right = node.right, None
+  return update_node(node), merge_nodes(tail, right)
+
+
+def merge_nodes(a, b):
+  """Join two trees of nodes, with all text of a before all text of b."""
+  if a is None:
+    return b
+  if b is None:
+    return a
+  if a.priority > b.priority:
+    a.right = merge_nodes(a.right, b)
+    return update_node(a)
+  b.left = merge_nodes(a, b.left)
+  return update_node(b)
+
+
+class Rope(object):
+  """Text that can be edited anywhere in O(log n).
+
+  The text is kept in chunks in a treap, in which every node knows the size
+  and number of newlines of its subtree. That also makes finding lines
+  O(log n).
+  """
+  chunk_size = 512  # Size of new chunks; they can grow to twice that
+
+  def __init__(self, text=''):
+    self.root = self._build(text)
+
+  def __len__(self):
+    return node_size(self.root)
+
+  @property
+  def text(self):
+    return self.slice(0, len(self))
+
+  @property
+  def line_count(self):
+    return node_lines(self.root) + 1
+
+  def _build(self, text):
+    root = None
+    for i in xrange(0, len(text), self.chunk_size):
+      root = merge_nodes(root, RopeNode(text[i:i + self.chunk_size]))
+    return root
+
+  def _path(self, pos):
+    """Return the nodes from the root to the node that contains pos, and pos in that node."""
+    path = []
+    node = self.root
+    while node:
+      path.append(node)
+      left_size = node_size(node.left)
+      if pos < left_size:
+        node = node.left
+      elif pos - left_size <= len(node.text):
+        return path, pos - left_size
+      else:
+        pos -= left_size + len(node.text)
+        node = node.right
+    return path, pos
+
+  def insert(self, pos, text):
+    path, offset = self._path(pos)
+    if path and len(path[-1].text) + len(text) <= 2 * self.chunk_size:
+      # Fits in an existing chunk
+      newlines = text.count('\n')
+      for node in path:
+        node.size += len(text)
+        node.lines += newlines
+      node = path[-1]
+      node.text = node.text[:offset] + text + node.text[offset:]
+      node.newlines += newlines
+      return
+    before, after = split_nodes(self.root, pos)
+    self.root = merge_nodes(merge_nodes(before, self._build(text)), after)
+
+  def delete(self, start, end):
+    """Remove the text from start to end."""
+    end = min(end, len(self))
+    if start >= end:
+      return
+    path, offset = self._path(start)
+    if path and offset + end - start <= len(path[-1].text):
+      # All of it is in one chunk
+      node = path[-1]
+      newlines = node.text.count('\n', offset, offset + end - start)
+      for n in path:
+        n.size -= end - start
+        n.lines -= newlines
+      node.text = node.text[:offset] + node.text[offset + end - start:]
+      node.newlines -= newlines
+      return
+    before, rest = split_nodes(self.root, start)
+    _, after = split_nodes(rest, end - start)
+    self.root = merge_nodes(before, after)
+
+  def slice(self, start, end):
+    """Return the text from start to end."""
+    parts = []
+    self._collect(self.root, start, end, parts)
+    return ''.join(parts)
+
+  def _collect(self, node, start, end, parts):
+    if node is None or start >= end:
+      return
+    left_size = node_size(node.left)
+    if start < left_size:
+      self._collect(node.left, start, min(end, left_size), parts)
+    text_end = left_size + len(node.text)
+    if start < text_end and end > left_size:
+      parts.append(node.text[max(0, start - left_size):end - left_size])
+    if end > text_end:
+      self._collect(node.right, max(0, start - text_end), end - text_end, parts)
+
+  def line_start(self, line):
+    """Return the offset at which a line starts."""
+    if line <= 0:
+      return 0
+    node, base = self.root, 0
+    while node:
+      left_lines = node_lines(node.left)
+      if line <= left_lines:
+        node = node.left
+        continue
+      line -= left_lines
+      base += node_size(node.left)
+      if line <= node.newlines:
+        at = -1
+        for _ in xrange(line):
+          at = node.text.index('\n', at + 1)
+        return base + at + 1
+      line -= node.newlines
+      base += len(node.text)
+      node = node.right
+    return len(self)
+
+  def line_end(self, line):
+    """Return the offset at which a line ends, without the newline."""
+    if line + 1 >= self.line_count:
+      return len(self)
+    return self.line_start(line + 1) - 1
+
+  def line_of(self, pos):
+    """Return the line that offset pos is on."""
+    node, line = self.root, 0
+    while node:
+      left_size = node_size(node.left)
+      if pos <= left_size:
+        node = node.left
+        continue
+      line += node_lines(node.left)
+      pos -= left_size
+      if pos <= len(node.text):
+        return line + node.text.count('\n', 0, pos)
+      line += node.newlines
+      pos -= len(node.text)
+      node = node.right
+    return line
+
+
+class TextArea(Control):
+  """Multi-line text edit control.
+
+  The text is kept in a Rope, so editing big texts is as fast as small ones,
+  and only the lines that are visible are rendered.
+  """
+  def __init__(self, value='', width=60, height=10, **kwargs):
+    super(TextArea, self).__init__(**kwargs)
+    self.rope = Rope(value)
+    self.width = width
+    self.height = height
+    self.cursor = 0
+    self.top = 0          # First visible line
+    self.left = 0         # First visible column
+    self.goal_column = None  # Column to return to when moving up and down
+    self.can_focus = True
+
+  @property
+  def value(self):
+    return self.rope.text
+
+  @value.setter
+  def value(self, value):
+    self.rope = Rope(value)
+    self.cursor = 0
+    self.top = 0
+    self.left = 0
+
+  @property
+  def cursor_line(self):
+    return self.rope.line_of(self.cursor)
+
+  @property
+  def cursor_column(self):
+    return self.cursor - self.rope.line_start(self.cursor_line)
+
+  def insert(self, text):
+    """Insert text at the cursor."""
+    self.rope.insert(self.cursor, text)
+    self.cursor += len(text)
+    self.invalidate()
+
+  def delete(self, start, end):
+    self.rope.delete(start, end)
+    self.cursor = start
+    self.invalidate()
+
+  def move_to_line(self, line):
+    """Move the cursor to a line, staying in the same column if possible."""
+    line = max(0, min(line, self.rope.line_count - 1))
+    if self.goal_column is None:
+      self.goal_column = self.cursor_column
+    start = self.rope.line_start(line)
+    self.cursor = min(start + self.goal_column, self.rope.line_end(line))
+
+  def _scroll_to_cursor(self):
+    line, column = self.cursor_line, self.cursor_column
+    self.top = max(min(self.top, line), line - self.height + 1)
+    if column < self.width:
+      self.left = 0
+    else:
+      self.left = max(min(self.left, column), column - self.width + 1)
+
+  def render(self, app):
+    focused = app.contains_focus(self)
+    self._scroll_to_cursor()
+    cursor_line, cursor_column = self.cursor_line, self.cursor_column
+
+    lines = []
+    for i in xrange(self.top, min(self.top + self.height, self.rope.line_count)):
+      start = self.rope.line_start(i) + self.left
+      # Only take the part that fits, so long lines aren't copied whole
+      text = self.rope.slice(start, min(self.rope.line_end(i), start + self.width))
+      cursor = (cursor_column - self.left, 0) if focused and i == cursor_line else None
+      lines.append(Display(text, min_width=self.width, fg=self.fg, cursor=cursor))
+    lines.extend(Display('', min_width=self.width) for _ in xrange(self.height - len(lines)))
+    return Vertical(lines)
+
+  def on_event(self, ev):
+    if ev.type == 'key':
+      vertical = ev.key in [curses.KEY_UP, curses.KEY_DOWN, curses.KEY_PPAGE, curses.KEY_NPAGE]
+      if not vertical:
+        self.goal_column = None
+
+      line = self.cursor_line
+      if ev.key == curses.KEY_UP and line > 0:
+        self.move_to_line(line - 1)
+        ev.stop()
+      if ev.key == curses.KEY_DOWN and line < self.rope.line_count - 1:
+        self.move_to_line(line + 1)
+        ev.stop()
+      if ev.key == curses.KEY_PPAGE:
+        self.move_to_line(line - self.height)
+        ev.stop()
+      if ev.key == curses.KEY_NPAGE:
+        self.move_to_line(line + self.height)
+        ev.stop()
+      if ev.key == curses.KEY_LEFT and self.cursor > 0:
+        self.cursor -= 1
+        ev.stop()
+      if ev.key == curses.KEY_RIGHT and self.cursor < len(self.rope):
+        self.cursor += 1
+        ev.stop()
+      if ev.key in [CTRL_A, curses.KEY_HOME]:
+        self.cursor = self.rope.line_start(line)
+        ev.stop()
+      if ev.key in [CTRL_E, curses.KEY_END]:
+        self.cursor = self.rope.line_end(line)
+        ev.stop()
+      if ev.key in [curses.KEY_BACKSPACE, MAC_BACKSPACE]:
+        if self.cursor > 0:
+          self.delete(self.cursor - 1, self.cursor)
+        ev.stop()
+      elif ev.key in [curses.ascii.DEL, OTHER_DEL]:
+        self.delete(self.cursor, self.cursor + 1)
+        ev.stop()
+      if is_enter(ev):
+        self.insert('\n')
+        ev.stop()
+      if 32 <= ev.key < 127:
+        self.insert(chr(ev.key))
+        ev.stop()
+    if ev.type == 'paste':
+      self.insert(''.join(c for c in ev.what if c == '\n' or ' ' <= c != '\x7f'))
+      ev.stop()
+
 
 class Button(Control):
   """Button which calls an event handler if hit."""
@@ -1070,14 +2504,321 @@ class Button(Control):
     if ev.type == 'key':
       if is_enter(ev) or ev.what == ord(' '):
         if self.on_click:
-          self.on_click(ev.app)
+          result = self.on_click(ev.app)
+          if is_task(result):
+            ev.app.spawn(result)
           ev.stop()
 
 
+class TextBuffer(object):
+  """Text that can be appended to, with an index of where its lines start.
+
+  The text is kept in chunks, so appending does not copy what is already
+  there, and only the new text is searched for newlines.
+  """
+  chunk_size = 8192  # Smaller chunks are merged into the last one
+
+  def __init__(self, text=''):
+    self.chunks = []
+    self.chunk_starts = array.array('L')
+    self.size = 0
+    self.line_starts = array.array('L', [0])
+    self.append(text)
+
+  @property
+  def line_count(self):
+    return len(self.line_starts)
+
+  @property
+  def complete_lines(self):
+    # The last line can still grow
+    return len(self.line_starts) - 1
+
+  @property
+  def text(self):
+    return self.text_range(0, self.line_count)
+
+  def append(self, data):
+    newline = data.find('\n')
+    while newline != -1:
+      self.line_starts.append(self.size + newline + 1)
+      newline = data.find('\n', newline + 1)
+
+    if self.chunks and len(self.chunks[-1]) < self.chunk_size:
+      self.chunks[-1] += data
+    elif data:
+      self.chunk_starts.append(self.size)
+      self.chunks.append(data)
+    self.size += len(data)
+
+  def slice(self, start, end):
+    """Return the text from start to end."""
+    i = bisect.bisect_right(self.chunk_starts, start) - 1
+    parts = []
+    while i < len(self.chunks) and start < end:
+      offset = self.chunk_starts[i]
+      parts.append(self.chunks[i][start - offset:end - offset])
+      start = offset + len(self.chunks[i])
+      i += 1
+    return ''.join(parts)
+
+  def line_span(self, i):
+    """Return the start and end offset of line i, without the newline."""
+    end = self.line_starts[i + 1] - 1 if i + 1 < len(self.line_starts) else self.size
+    return self.line_starts[i], end
+
+  def line(self, i, skip=0, width=None):
+    """Return line i, leaving out the first skip characters, and at most width characters."""
+    start, end = self.line_span(i)
+    start = min(start + skip, end)
+    return self.slice(start, end if width is None else min(end, start + width))
+
+  def text_range(self, first, last):
+    """Return the text of lines first up to last, joined by newlines."""
+    if first >= last:
+      return ''
+    return self.slice(self.line_starts[first], self.line_span(last - 1)[1])
+
+
+def index_newlines(filename, start, end):
+  """Return the offsets just after all newlines in a part of a file, as array data.
+
+  Runs in worker processes, so it opens the file itself.
+  """
+  with open(filename, 'rb') as f:
+    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      starts = array.array('L')
+      newline = mapped.find('\n', start, end)
+      while newline != -1:
+        starts.append(newline + 1)
+        newline = mapped.find('\n', newline + 1, end)
+      return starts.tostring()
+    finally:
+      mapped.close()
+
+
+class MappedText(TextBuffer):
+  """A file as a document for PreviewPane, without reading it into memory.
+
+  The file is memory-mapped; only the offsets of its lines are kept. The
+  file is indexed in blocks, either right away with index() or on worker
+  processes with index_in_background(app). Until then, only the lines that
+  have been indexed are there.
+  """
+  block_size = 16 * 1024 * 1024
+
+  def __init__(self, filename):
+    self.filename = filename
+    with open(filename, 'rb') as f:
+      self.size = os.fstat(f.fileno()).st_size
+      self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else ''
+    self.line_starts = array.array('L', [0])
+    self.indexed = 0   # Bytes at the start of the file that have been indexed
+    self.pending = {}  # Block start -> line starts, for blocks indexed out of order
+
+  @property
+  def done(self):
+    return self.indexed >= self.size
+
+  @property
+  def line_count(self):
+    # The last line may continue in the part that has not been indexed yet
+    return len(self.line_starts) if self.done else len(self.line_starts) - 1
+
+  @property
+  def complete_lines(self):
+    # The file doesn't grow, so only a line that is not fully indexed is incomplete
+    return self.line_count
+
+  @property
+  def chunks(self):
+    for start in xrange(0, self.size, self.block_size):
+      yield self.map[start:start + self.block_size]
+
+  def append(self, data):
+    raise ValueError('%s is shown from the file and cannot be appended to' % self.filename)
+
+  def close(self):
+    if self.size:
+      self.map.close()
+
+  def slice(self, start, end):
+    return self.map[start:end]
+
+  def index(self):
+    """Index the rest of the file."""
+    for start, end in self._blocks():
+      self._add_block(start, index_newlines(self.filename, start, end))
+
+  def index_in_background(self, app, on_progress=None, processes=True):
+    """Index the file on a pool of worker processes (or threads).
+
+    on_progress() is called whenever more lines are available.
+    """
+    for start, end in self._blocks():
+      def on_done(app, data, start=start):
+        self._add_block(start, data)
+        if on_progress:
+          on_progress()
+      app.run_in_background(index_newlines, on_done, args=(self.filename, start, end), processes=processes)
+
+  def _blocks(self):
+    return [(start, min(start + self.block_size, self.size))
+            for start in xrange(self.indexed, self.size, self.block_size)]
+
+  def _add_block(self, start, data):
+    self.pending[start] = data
+    while self.indexed in self.pending:
+      starts = array.array('L')
+      starts.fromstring(self.pending.pop(self.indexed))
+      self.line_starts.extend(starts)
+      self.indexed = min(self.indexed + self.block_size, self.size)
+
+
+class LineSearch(object):
+  """Finds the lines of a TextBuffer that match a regex, a chunk at a time.
+
+  The pattern ignores case if it has no capitals, and is searched for
+  literally if it is not a valid regex. Searches the given line numbers below
+  line covered, and then all lines from there on; without candidates, that
+  is all lines. Lines that are added to the buffer later are searched too.
+  """
+  chunk_size = 5000  # Lines per step
+
+  def __init__(self, buffer, pattern, candidates=None, covered=0):
+    self.buffer = buffer
+    self.pattern = pattern
+    self.candidates = array.array('L', candidates) if candidates is not None else None
+    self.covered = covered if candidates is not None else 0
+    flags = re.MULTILINE | (re.IGNORECASE if pattern == pattern.lower() else 0)
+    try:
+      self.regex = re.compile(pattern, flags)
+      self.literal = False
+    except re.error:
+      self.regex = re.compile(re.escape(pattern), flags)
+      self.literal = True
+    self.matches = array.array('L')  # Matching line numbers found so far
+    self.pos = 0                     # Position in the candidates to continue at
+    self.line = self.covered         # Line to continue the scan of all lines at
+    self.searched = 0                # Size of the buffer when we last scanned
+    self.running = False             # Whether a task is continuing the search
+
+  @property
+  def done(self):
+    if self.candidates is not None and self.pos < len(self.candidates):
+      return False
+    # The last line may still grow, then it is searched again
+    return (self.line >= self.buffer.line_count
+            or (self.line >= self.buffer.complete_lines and self.searched == self.buffer.size))
+
+  def narrowed(self, pattern):
+    """Return a search for a longer pattern, reusing our matches if we can.
+
+    Adding letters or digits to a pattern can only match fewer lines.
+    """
+    added = pattern[len(self.pattern):]
+    if not (pattern.startswith(self.pattern) and added.isalnum() and '\\' not in self.pattern):
+      return LineSearch(self.buffer, pattern)
+    if self.done:
+      # Lines from self.line on may still change, so they are scanned again
+      candidates = self.matches[:bisect.bisect_left(self.matches, self.line)]
+      search = LineSearch(self.buffer, pattern, candidates, self.line)
+    elif self.candidates is not None:
+      search = LineSearch(self.buffer, pattern, self.candidates, self.covered)
+    else:
+      search = LineSearch(self.buffer, pattern)
+    if search.literal != self.literal:
+      search = LineSearch(self.buffer, pattern)
+    return search
+
+  def step(self):
+    if self.candidates is not None and self.pos < len(self.candidates):
+      self._step_candidates()
+    else:
+      self._step_lines()
+
+  def _step_candidates(self):
+    # Take candidates that are close together, and search their lines in one block
+    buffer = self.buffer
+    candidates = self.candidates
+    end = min(self.pos + self.chunk_size, len(candidates))
+    end = bisect.bisect_left(candidates, candidates[self.pos] + 4 * self.chunk_size, self.pos, end)
+    offset = buffer.line_starts[candidates[self.pos]]
+    text = buffer.slice(offset, buffer.line_span(candidates[end - 1])[1])
+    for i in candidates[self.pos:end]:
+      start, stop = buffer.line_span(i)
+      if self.regex.search(text, start - offset, stop - offset):
+        self.matches.append(i)
+    self.pos = end
+
+  def _step_lines(self):
+    # Search a block of lines at once, and find out which lines matched
+    buffer = self.buffer
+    first, last = self.line, min(self.line + self.chunk_size, buffer.line_count)
+    if first >= last:
+      return
+    starts = buffer.line_starts
+    offset = starts[first]
+    text = buffer.slice(offset, buffer.line_span(last - 1)[1])
+    match = self.regex.search(text)
+    while match:
+      line = bisect.bisect_right(starts, offset + match.start(), first, last) - 1
+      if not self.matches or self.matches[-1] != line:
+        # A line that is searched again can already be there
+        self.matches.append(line)
+      if line + 1 >= last:
+        break
+      match = self.regex.search(text, starts[line + 1] - offset)
+    self.line = min(last, buffer.complete_lines)
+    self.searched = buffer.size
+
+
+class PreviewLines(View):
+  """The lines of a PreviewPane that fit in the rectangle.
+
+  Lines are only read from the document when they are painted, and only the
+  part that fits.
+  """
+  def __init__(self, pane, attr, selected=None):
+    self.pane = pane
+    self.attr = attr
+    self.selected = selected  # Line to show as selected, if any
+
+  def _lines(self, rect):
+    first = self.pane.v_scroll_offset
+    return xrange(first, min(self.pane.buffer.line_count, first + rect.h))
+
+  def size(self, rect):
+    buffer, skip = self.pane.buffer, self.pane.h_scroll_offset
+    widths = [min(rect.w, max(0, end - start - skip)) for start, end in (buffer.line_span(i) for i in self._lines(rect))]
+    return max(widths or [0]), max(1, len(widths))
+
+  def disp(self, rect):
+    pane = self.pane
+    for y, i in enumerate(self._lines(rect)):
+      line = pane.buffer.line(i, pane.h_scroll_offset, rect.w)
+      attr = self.attr | (curses.A_STANDOUT if i == self.selected else 0)
+      pane._display_line(line, attr).display(rect.sub_rect(0, y, rect.w, 1))
+
+
 class PreviewPane(Control):
+  """A scrollable view on a large document.
+
+  Text can be added with append(), or read from a file as it grows with
+  follow(). When scrolled to the bottom, the pane stays at the bottom as
+  lines are added. To show a file that is too big to read into memory, use
+  show_file().
+
+  Type '/' and a regex to search, and 'n' and 'N' to go to the next and
+  previous matching line.
+  """
+  poll_interval = 0.5  # Seconds between checks for growth of followed files
+  cache_size = 32      # Number of searches to remember
+
   def __init__(self, text, row_selectable=False, on_select_row=None, **kwargs):
     super(PreviewPane, self).__init__(**kwargs)
-    self._text = text
+    self.buffer = TextBuffer(text)
     self.can_focus = True
     self.v_scroll_offset = 0
     self.h_scroll_offset = 0
@@ -1085,36 +2826,184 @@ class PreviewPane(Control):
     self.row_selectable = row_selectable
     self.selected_row = 0
     self.on_select_row = on_select_row
-    self._index_text()
+    self.last_render = None
+    self.followed = None  # (app, fd, TimerHandle or None) that we read from
+
+    self.query = ''           # The regex to search for
+    self.searching = False    # Whether typed keys go to the query
+    self.search = None        # LineSearch for the query, if any
+    self.searches = collections.OrderedDict()  # Query -> LineSearch, oldest first
+    self.search_origin = 0    # Line we were at when the search started
+    self.pending_jump = False  # Whether to go to the first match that is found
 
   @property
   def text(self):
-    return self._text
+    return self.buffer.text
 
   @text.setter
   def text(self, text):
-    self._text = text
-    self._index_text()
+    self._set_buffer(TextBuffer(text))
     if self.last_render:
-      self.v_scroll_offset = max(0, min(self.v_scroll_offset, len(self.lines) - self.last_render.rect.h))
+      self.v_scroll_offset = max(0, min(self.v_scroll_offset, self.buffer.line_count - self.last_render.rect.h))
 
   @property
   def lines(self):
-    ret = []
-    for l_start, l_end in self._lines:
-      ret.append(self._text[l_start:l_end])
-    return ret
+    return self.line_range(0, self.buffer.line_count)
 
-  def _index_text(self):
-    """Run through _text and index all the newlines in it."""
-    self._lines = []
+  def line_range(self, first, last):
+    """Return lines first up to last, without reading the rest of the document."""
+    return [self.buffer.line(i) for i in xrange(first, min(last, self.buffer.line_count))]
 
-    start = 0
-    newline = self._text.find('\n')
-    while newline != -1:
-      self._lines.append((start, newline))
-      start, newline = newline + 1, self._text.find('\n', newline + 1)
-    self._lines.append((start, len(self._text)))
+  @property
+  def page_height(self):
+    return self.last_render.rect.h if self.last_render else 0
+
+  def at_bottom(self):
+    return self.v_scroll_offset + self.page_height >= self.buffer.line_count
+
+  def append(self, text):
+    """Add text to the end of the document."""
+    self._check_appendable()
+    pinned = self.at_bottom()
+    self.buffer.append(text)
+    if pinned:
+      self.v_scroll_offset = max(0, self.buffer.line_count - self.page_height)
+    self.invalidate()
+
+  def follow(self, app, f):
+    """Append everything that is written to f (a file, pipe or socket), like tail -f.
+
+    Regular files are checked for growth every poll_interval seconds, other
+    files are read as soon as there is data.
+    """
+    self._check_appendable()
+    self.unfollow()
+    fd = fileno(f)
+    if stat.S_ISREG(os.fstat(fd).st_mode):
+      timer = app.enqueue(self.poll_interval, lambda app: self._read_file(fd), repeat=True)
+      self.followed = (app, fd, timer)
+      self._read_file(fd)
+    else:
+      self.followed = (app, fd, None)
+      app.add_reader(fd, lambda app: self._read_pipe(fd))
+
+  def show_file(self, app, filename):
+    """Show a file without reading it; its lines are indexed in the background."""
+    self.unfollow()
+    self._set_buffer(MappedText(filename))
+    self.v_scroll_offset = 0
+    self.selected_row = 0
+    self.buffer.index_in_background(app, on_progress=self.invalidate)
+
+  def _set_buffer(self, buffer):
+    if isinstance(self.buffer, MappedText):
+      self.buffer.close()
+    self.buffer = buffer
+    if self.search:
+      # Searches of the old buffer stop
+      self.set_query(self.query)
+
+  def _check_appendable(self):
+    if isinstance(self.buffer, MappedText):
+      raise ValueError('%s is shown with show_file(), set text first to append to the pane' % self.buffer.filename)
+
+  def unfollow(self):
+    if not self.followed:
+      return
+    app, fd, timer = self.followed
+    if timer:
+      timer.cancel()
+    else:
+      app.remove_reader(fd)
+    self.followed = None
+
+  def _read_file(self, fd):
+    data = os.read(fd, 65536)
+    while data:
+      self.append(data)
+      data = os.read(fd, 65536)
+
+  def _read_pipe(self, fd):
+    data = os.read(fd, 65536)
+    if data:
+      self.append(data)
+    else:
+      # The other end was closed
+      self.unfollow()
+
+  def set_query(self, query):
+    """Search for a regex, and highlight the matches.
+
+    A longer query only searches the lines that matched the shorter one, and
+    recent searches are remembered. On big documents, the search continues in
+    between frames.
+    """
+    if self.search and self.search.buffer is not self.buffer:
+      # The document was replaced
+      self.search = None
+      self.searches.clear()
+
+    self.query = query
+    if not query:
+      self.search = None
+      return
+
+    search = self.searches.pop(query, None)
+    if search is None:
+      search = self.search.narrowed(query) if self.search else LineSearch(self.buffer, query)
+    self.searches[query] = search
+    while len(self.searches) > self.cache_size:
+      self.searches.popitem(last=False)
+
+    self.search = search
+    self.pending_jump = True
+    self._jump_to_first_match()
+    self._run_search(search)
+
+  def jump_to_match(self, direction):
+    """Go to the next (direction 1) or previous (-1) matching line."""
+    matches = self.search.matches if self.search else []
+    if not matches:
+      return
+    current = self.selected_row if self.row_selectable else self.v_scroll_offset
+    if direction > 0:
+      i = bisect.bisect_right(matches, current) % len(matches)
+    else:
+      i = bisect.bisect_left(matches, current) - 1
+    self._move_to_line(matches[i])
+
+  def _move_to_line(self, line):
+    if self.row_selectable:
+      self.selected_row = line
+      if not self.v_scroll_offset <= line < self.v_scroll_offset + self.page_height:
+        self.v_scroll_offset = max(0, line - self.page_height / 2)
+    else:
+      self.v_scroll_offset = line
+
+  def _run_search(self, search):
+    run_steps(self, search, lambda: search is self.search, self._jump_to_first_match)
+
+  def _jump_to_first_match(self):
+    """While typing, go to the first match after where we started."""
+    if not self.pending_jump:
+      return
+    i = bisect.bisect_left(self.search.matches, self.search_origin)
+    if i < len(self.search.matches):
+      self._move_to_line(self.search.matches[i])
+      self.pending_jump = False
+
+  def _display_line(self, line, attr):
+    """Display a line, highlighting the matches of the search."""
+    styled = StyledText()
+    at = 0
+    for match in (self.search.regex.finditer(line) if self.search else []):
+      if match.end() > match.start():
+        styled.append(line[at:match.start()])
+        styled.append(match.group(), fg=yellow, attr=curses.A_REVERSE)
+        at = match.end()
+    if not styled.spans:
+      return Display(line, attr=attr)
+    return Display(styled.append(line[at:]), attr=attr)
 
   def render(self, app):
     self.app = app  # FIXME: That's nasty
@@ -1123,20 +3012,61 @@ class PreviewPane(Control):
     if focused:
       attr = curses.A_BOLD
 
-    MAX_HEIGHT = 1000  # No screen will ever contain more than this many lines
+    if self.search and self.search.buffer is not self.buffer:
+      self.set_query(self.query)
+    if self.search and not self.search.done:
+      # There are more lines since the search finished
+      self._run_search(self.search)
 
-    display_lines = list(self._text[l_start + self.h_scroll_offset:l_end] for l_start, l_end in self._lines[self.v_scroll_offset:self.v_scroll_offset + MAX_HEIGHT])
-    if self.row_selectable and focused:
-      hi_offset = self.selected_row - self.v_scroll_offset
-      self.last_render = Vertical([
-        Display(line, attr=attr + (curses.A_STANDOUT if i == hi_offset else 0)) for i, line in enumerate(display_lines)
-        ])
-    else:
-      self.last_render = Display(display_lines, attr=attr)
+    selected = self.selected_row if self.row_selectable and focused else None
+    self.last_render = PreviewLines(self, attr, selected)
+
+    if self.searching or self.search:
+      status = '/' + self.query + ('_' if self.searching else '')
+      if self.search:
+        status += '  (%d matches%s)' % (len(self.search.matches), '' if self.search.done else '...')
+      return Vertical([Display(status, fg=yellow), self.last_render])
     return self.last_render
 
+  def _search_key(self, ev):
+    """Handle a key for searching, returning whether it was used."""
+    if not self.searching:
+      if ev.key == ord('/'):
+        self.searching = True
+        self.search_origin = self.selected_row if self.row_selectable else self.v_scroll_offset
+        self.set_query('')
+        return True
+      if ev.key in [ord('n'), ord('N')] and self.search:
+        self.jump_to_match(1 if ev.key == ord('n') else -1)
+        return True
+      if ev.key == curses.ascii.ESC and self.search:
+        self.set_query('')
+        return True
+      return False
+
+    if 32 <= ev.key < 127:
+      self.set_query(self.query + chr(ev.key))
+    elif ev.key in [curses.KEY_BACKSPACE, MAC_BACKSPACE]:
+      if self.query:
+        self.set_query(self.query[:-1])
+      else:
+        self.searching = False
+    elif ev.key == curses.ascii.ESC:
+      self.searching = False
+      self.set_query('')
+      self._move_to_line(self.search_origin)
+    elif is_enter(ev):
+      self.searching = False
+    else:
+      return False
+    return True
+
   def on_event(self, ev):
     if ev.type == 'key':
+      if self._search_key(ev):
+        ev.stop()
+        return
+
       h_scrolls = {
           curses.KEY_LEFT: -10,
           ord('h'): -10,
@@ -1144,12 +3074,13 @@ class PreviewPane(Control):
           ord('l'): 10,
           }
 
+      line_count = self.buffer.line_count
       if self.row_selectable:
         # We scroll the focus
-        change, self.selected_row, self.v_scroll_offset = handle_scroll_key(ev.key, self.selected_row, len(self._lines), self.v_scroll_offset, self.last_render.rect.h, page_size=30)
+        change, self.selected_row, self.v_scroll_offset = handle_scroll_key(ev.key, self.selected_row, line_count, self.v_scroll_offset, self.last_render.rect.h, page_size=30)
       else:
         # We scroll the screen
-        change, self.v_scroll_offset, _ = handle_scroll_key(ev.key, self.v_scroll_offset, len(self._lines), self.v_scroll_offset, self.last_render.rect.h, page_size=30)
+        change, self.v_scroll_offset, _ = handle_scroll_key(ev.key, self.v_scroll_offset, line_count, self.v_scroll_offset, self.last_render.rect.h, page_size=30)
 
       if change:
         ev.stop()
@@ -1162,10 +3093,9 @@ class PreviewPane(Control):
 
       if ev.key == ord('s'):
         EditPopup(ev.app, self._save_contents, value='report.log', caption='Save to file')
-      if is_enter(ev) and self.row_selectable and self.on_select_row and 0 <= self.row_selectable < len(self._lines):
+      if is_enter(ev) and self.row_selectable and self.on_select_row and 0 <= self.row_selectable < line_count:
 
-        l_start, l_end = self._lines[self.selected_row]
-        self.on_select_row(self._text[l_start:l_end], ev.app)
+        self.on_select_row(self.buffer.line(self.selected_row), ev.app)
         ev.stop()
 
   def _save_contents(self, box, app):
@@ -1173,7 +3103,8 @@ class PreviewPane(Control):
 
     try:
       with file(filename, 'w') as f:
-        f.write(self._text)
+        for chunk in self.buffer.chunks:
+          f.write(chunk)
       Toasty('%s saved' % filename).show(self.app)
     except Exception, e:
       Toasty(str(e), duration=datetime.timedelta(seconds=5)).show(self.app)
@@ -1189,11 +3120,13 @@ class SwitchableControl(Control):
       # Keep focus if we had focus before, but don't steal it otherwise
       had_focus = app.contains_focus(self)
       self.controls[:] = [control]
+      self.invalidate()
+      app.reindex(self)
       if had_focus:
         control.enter_focus('', app)
 
     def render(self, app):
-      return self.controls[0].render(app)
+      return self.controls[0].view(app)
 
 
 #----------------------------------------------------------------------
@@ -1230,6 +3163,201 @@ class Rect(object):
     return '(%s,%s,%s,%s)' % (self.x, self.y, self.w, self.h)
 
 
+def clip_size(size, rect):
+  """Return the part of a view's size that falls inside the rect."""
+  return max(0, min(size[0], rect.w)), max(0, min(size[1], rect.h))
+
+
+class CountingScreen(object):
+  """Passes paint calls on to a screen, counting them for the profiler."""
+  def __init__(self, screen, profiler):
+    self.screen = screen
+    self.profiler = profiler
+
+  def getmaxyx(self):
+    return self.screen.getmaxyx()
+
+  def _paint(self, name, args):
+    self.profiler.count('curses_calls')
+    getattr(self.screen, name)(*args)
+
+  def addstr(self, *args):
+    self._paint('addstr', args)
+
+  def addch(self, *args):
+    self._paint('addch', args)
+
+  def hline(self, *args):
+    self._paint('hline', args)
+
+  def vline(self, *args):
+    self._paint('vline', args)
+
+
+class VirtualScreen(object):
+  """A screen in memory, to use instead of a curses window without a terminal.
+
+  It has the parts of the window API that sailor uses. What is painted ends up
+  in `cells`, rows of (character, attributes). Keys given to feed() are
+  returned by getch(), so App.run(screen) can be scripted.
+  """
+  COLORS = 256
+  COLOR_PAIRS = 256
+
+  def __init__(self, width=80, height=24, keys=()):
+    self.width = width
+    self.height = height
+    self.delay = -1
+    self.refreshes = 0
+    self.pairs = {0: (white, black)}
+    self.keys = collections.deque()
+    # Readable while there are keys, so the app can select() on it
+    self.key_r, self.key_w = os.pipe()
+    fcntl.fcntl(self.key_r, fcntl.F_SETFL, os.O_NONBLOCK)
+    self.erase()
+    self.feed(keys)
+
+  def feed(self, keys):
+    """Add keys to read, as a string or a list of key codes."""
+    keys = [ord(k) if isinstance(k, basestring) else k for k in keys]
+    if keys:
+      self.keys.extend(keys)
+      os.write(self.key_w, 'x')
+
+  def fileno(self):
+    return self.key_r
+
+  def close(self):
+    os.close(self.key_r)
+    os.close(self.key_w)
+
+  def getmaxyx(self):
+    return self.height, self.width
+
+  def erase(self):
+    self.cells = [[(' ', 0)] * self.width for _ in xrange(self.height)]
+
+  def refresh(self):
+    self.refreshes += 1
+
+  def timeout(self, delay):
+    # There is nothing to wait for, getch() never blocks
+    self.delay = delay
+
+  def getch(self):
+    if not self.keys:
+      return -1
+    key = self.keys.popleft()
+    if not self.keys:
+      try:
+        os.read(self.key_r, 4096)
+      except OSError, e:
+        if e.errno != errno.EAGAIN:
+          raise
+    return key
+
+  def init_pair(self, pair, fg, bg):
+    self.pairs[pair] = (fg, bg)
+
+  def pair_content(self, pair):
+    return self.pairs[pair]
+
+  def addstr(self, y, x, text, attr=0):
+    if not (0 <= y < self.height and 0 <= x < self.width):
+      raise curses.error('addstr() returned ERR')
+    # Like curses, wrap to the next lines, and fail after the last cell
+    at = y * self.width + x
+    for i, ch in enumerate(text[:self.height * self.width - at]):
+      self.cells[(at + i) // self.width][(at + i) % self.width] = (ch, attr)
+    if at + len(text) >= self.height * self.width:
+      raise curses.error('addstr() returned ERR')
+
+  def addch(self, y, x, ch, attr=0):
+    ch, ch_attr = self._char(ch)
+    self.addstr(y, x, ch, attr | ch_attr)
+
+  def hline(self, y, x, ch, n):
+    self._line(y, x, ch, n, 0, 1)
+
+  def vline(self, y, x, ch, n):
+    self._line(y, x, ch, n, 1, 0)
+
+  def _line(self, y, x, ch, n, dy, dx):
+    if not (0 <= y < self.height and 0 <= x < self.width):
+      raise curses.error('line() returned ERR')
+    cell = self._char(ch)
+    for i in xrange(min(n, self.height - y if dy else self.width - x)):
+      self.cells[y + i * dy][x + i * dx] = cell
+
+  def _char(self, ch):
+    """Split a character or chtype into the character and its attributes."""
+    if isinstance(ch, basestring):
+      return ch, 0
+    return chr(ch & curses.A_CHARTEXT), ch & ~curses.A_CHARTEXT
+
+  def text(self):
+    """Return the characters on the screen, as lines."""
+    return [''.join(ch for ch, _ in row).rstrip() for row in self.cells]
+
+
+class InputParser(object):
+  """Turns keys read with getch() into (type, what) pairs for events.
+
+  Keys become 'key' events. Text that the terminal marks as pasted becomes a
+  single 'paste' event with the text, without control keys other than tabs
+  and newlines. A paste can be read in several parts.
+  """
+  def __init__(self):
+    self.pending = []  # Keys that may be the start of PASTE_START
+    self.paste = None  # Keys of the paste being read
+    self.events = []
+
+  @property
+  def incomplete(self):
+    """Whether we are in the middle of a paste marker or a paste."""
+    return bool(self.pending) or self.paste is not None
+
+  def feed(self, key):
+    if self.paste is not None:
+      self.paste.append(key)
+      if self.paste[-len(PASTE_END):] == PASTE_END:
+        self._end_paste(self.paste[:-len(PASTE_END)])
+      return
+
+    self.pending.append(key)
+    if self.pending == PASTE_START[:len(self.pending)]:
+      if len(self.pending) == len(PASTE_START):
+        self.paste = []
+        self.pending = []
+      return
+
+    # Not a paste after all, but the last key may start one
+    keys, self.pending = self.pending, []
+    self.events.extend(('key', k) for k in keys[:-1])
+    if keys[-1] == PASTE_START[0]:
+      self.pending = keys[-1:]
+    else:
+      self.events.append(('key', keys[-1]))
+
+  def flush(self):
+    """Give up on waiting for the rest of a marker.
+
+    A paste stays open until its end marker comes in, so that none of it is
+    taken for typed keys.
+    """
+    self.events.extend(('key', k) for k in self.pending)
+    self.pending = []
+
+  def take_events(self):
+    events, self.events = self.events, []
+    return events
+
+  def _end_paste(self, keys):
+    text = ''.join(chr(k) for k in keys if k in PASTE_CONTROL_KEYS or 32 <= k < 256 and k != MAC_BACKSPACE)
+    self.events.append(('paste', text.replace('\r\n', '\n').replace('\r', '\n')))
+    self.paste = None
+
+
 class Event(object):
   def __init__(self, type, what, target, app):
     self.type = type
@@ -1244,7 +3372,10 @@ class Event(object):
     self.propagating = False
 
 
-def object_tree(root):
+def object_tree(root, profiler=None):
+  """Yield (parent, control) for root and everything under it, depth first."""
+  if profiler:
+    profiler.count('object_tree')
   stack = [(None, root)]
   while stack:
     parent, obj = stack.pop()
@@ -1271,13 +3402,13 @@ class Layer(Control):
     self._focus_first()
 
   def _focus_first(self):
-    for parent, child in object_tree(self):
+    for parent, child in object_tree(self, self.app.profiler):
       if child.can_focus:
         self.focus(child)
         return
 
   def _focus_last(self):
-    controls = list(object_tree(self))
+    controls = list(object_tree(self, self.app.profiler))
     controls.reverse()
     for parent, child in controls:
       if child.can_focus:
@@ -1290,23 +3421,33 @@ class Layer(Control):
     self.focused = ctrl
     self.focused.on_event(Event('focus', None, self.focused, self.app))
 
+  # Layers are bookkeeping, they don't look different when changed
+  __setattr__ = object.__setattr__
+
   def children(self):
     return [self.root]
 
   def render(self, app):
-    return self.root.render(app)
+    return self.root.view(app)
 
 
 class TimerHandle(object):
-  def __init__(self, app, timer_id):
+  def __init__(self, app, timer_id, on_time=None, interval=None):
     self.app = app
     self.timer_id = timer_id
+    self.on_time = on_time
+    self.interval = interval  # Seconds between repeats, or None
+    self.pending = True  # Whether the timer is in the queue
+    self.cancelled = False
 
   def cancel(self):
-    for i, (_, _, timer_id) in enumerate(self.app.timers):
-      if timer_id == self.timer_id:
-        self.app.timers.pop(i)
-        break
+    if self.cancelled:
+      return
+    self.cancelled = True
+    if self.pending:
+      # The timer stays in the queue until it comes up, or the queue is compacted
+      self.app.cancelled_timers += 1
+      self.app.compact_timers()
 
 
 class LayerHandle(object):
@@ -1318,28 +3459,136 @@ class LayerHandle(object):
     for i, layer in enumerate(self.app.layers):
       if layer.id == self.layer_id:
         self.app.layers.pop(i)
+        self.app.reindex(self.app)
         break
 
 
+class ColorPairs(object):
+  """Hands out curses color pairs for (foreground, background) combinations.
+
+  Terminals only have so many pairs. When all of them are taken, the ones
+  that were used longest ago are given new colors. Whatever was painted with
+  them changes color too, so the screen must be painted again after that:
+  `evicted` tells whether it happened. The `common` pairs are set up at the
+  start and never reused.
+  """
+  max_pairs = 256  # color_pair() can't address more
+
+  def __init__(self, common=(), terminal=curses):
+    self.common = list(common)
+    self.terminal = terminal  # Where pairs are set up: curses, or a VirtualScreen
+    self.pairs = {}    # (fg, bg) -> pair number
+    self.used = {}     # (fg, bg) -> frame it was last used in
+    self.free = None   # Pair numbers that are not in use, set up on first use
+    self.frame = 0
+    self.evicted = False
+
+  def get(self, fg, bg):
+    key = (fg, bg)
+    pair = self.pairs.get(key)
+    if pair is None:
+      pair = self._allocate(key)
+    self.used[key] = self.frame
+    return pair
+
+  def next_frame(self):
+    self.frame += 1
+
+  def _setup(self):
+    limit = min(getattr(self.terminal, 'COLOR_PAIRS', 64), self.max_pairs)
+    self.free = range(limit - 1, 0, -1)  # Pair 0 can't be changed
+    for key in self.common[:len(self.free) // 2]:
+      self._allocate(key)
+
+  def _allocate(self, key):
+    if self.free is None:
+      self._setup()
+    if not self.free:
+      self._evict()
+    pair = self.free.pop()
+    fg, bg = key
+    colors = getattr(self.terminal, 'COLORS', 8)
+    self.terminal.init_pair(pair, fg if fg < colors else basic_color(fg), bg if bg < colors else basic_color(bg))
+    self.pairs[key] = pair
+    return pair
+
+  def _evict(self):
+    """Free the least recently used quarter of the pairs."""
+    common = set(self.common)
+    # Rather not take pairs that are on the screen in this frame
+    oldest = sorted((self.used.get(k, -1), k) for k in self.pairs if k not in common)
+    unused = [k for used, k in oldest if used < self.frame]
+    for _, key in zip(xrange(max(1, len(oldest) // 4)), unused or [k for _, k in oldest]):
+      self.free.append(self.pairs.pop(key))
+      self.used.pop(key, None)
+    self.evicted = True
+
+
 class App(Control):
+  # The App paints everything, changing it doesn't need painting by itself
+  __setattr__ = object.__setattr__
+
   def __init__(self, root):
     super(App, self).__init__()
     self.exit = False
-    self.screen = None
     self.layers = []
-    self.color_cache = {}
-    self.color_counter = 1
-    self.timers = []
+    self.colors = ColorPairs((fg, black) for fg in [white, red, green, blue, cyan, magenta, yellow, black])
+    self.screen = None
+    self.profiler = None     # Profiler, when profiling
+    self.stats_layer = None  # Layer that shows the profiler's stats
+    self.timers = []           # Heap of (deadline, timer id, TimerHandle)
+    self.cancelled_timers = 0  # Number of cancelled timers still in the heap
+    self.timer_slack = 0.01    # Timers due within this many seconds fire together
     self.uniq_id = 0
+    self.input = InputParser()
+    self.readers = {}  # fd -> on_ready(app)
+    self.waiting_tasks = {}  # fd -> tasks that wait for it to be readable
+    self.posted = collections.deque()  # Callables posted from other threads
+    self.pools = {}                    # processes? -> worker pool
+    self.wakeup_r, self.wakeup_w = os.pipe()
+    for fd in [self.wakeup_r, self.wakeup_w]:
+      fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    self.add_reader(self.wakeup_r, self.run_posted)
+
+    self.dirty = set()      # Controls invalidated since the last frame
+    self.views = {}         # Control -> last rendered View
+    self.sizes = {}         # Control -> ((w, h) of rect, size of the View)
+    self.measured = {}      # (View, w, h) -> size, for the current frame
+    self.regions = {}       # Control -> (rect, measured size) of the last paint
+    self.painted = set()    # Controls painted in the current frame
+    self.screen_layout = None  # Screen size and layers at the last full paint
+    self.focus_shown = None    # Focused control at the last frame
+    self.parents = {}          # Control -> parent, for all controls in the tree
+    self.child_index = {}      # Control -> children, as they are in self.parents
+    self.ids = {}              # Id -> controls in the tree with that id
+    self.focus_path = set()    # The focused control and its ancestors
+    self.focus_path_of = None  # The focused control that focus_path is for
+    self.control_ids = {}      # Control -> id, as it is in self.ids
 
     self.push_layer(root)
 
-  def enqueue(self, delta, on_time):
-    deadline = datetime.datetime.now() + delta
+  def enqueue(self, delta, on_time, repeat=False):
+    """Call on_time(app) after delta (a timedelta, or seconds) has passed.
+
+    With repeat=True, on_time is called every delta until the timer is
+    cancelled.
+    """
+    if isinstance(delta, datetime.timedelta):
+      delta = delta.total_seconds()
     self.uniq_id += 1
-    self.timers.append((deadline, on_time, self.uniq_id))
-    self.timers.sort()
-    return TimerHandle(self, self.uniq_id)
+    handle = TimerHandle(self, self.uniq_id, on_time, delta if repeat else None)
+    heapq.heappush(self.timers, (monotonic() + delta, self.uniq_id, handle))
+    return handle
+
+  def compact_timers(self):
+    """Drop cancelled timers, once they make up most of the queue."""
+    while self.timers and self.timers[0][2].cancelled:
+      heapq.heappop(self.timers)
+      self.cancelled_timers -= 1
+    if self.cancelled_timers > len(self.timers) / 2:
+      self.timers = [t for t in self.timers if not t[2].cancelled]
+      heapq.heapify(self.timers)
+      self.cancelled_timers = 0
 
   @property
   def active_layer(self):
@@ -1353,22 +3602,103 @@ class App(Control):
     assert(isinstance(control, Control))
     self.uniq_id += 1
     self.layers.append(Layer(control, self, modal, self.uniq_id))
+    self.reindex(self)
     return LayerHandle(self, self.uniq_id)
 
-  def _all_objects(self):
-    return object_tree(self)
-
   def children(self):
     return self.layers
 
   def get_parent(self, ctrl):
-    for parent, child in self._all_objects():
-      if child is ctrl:
-        return parent
-    return None
+    return self.parents.get(ctrl)
+
+  def reindex(self, ctrl):
+    """Bring the parent index up to date after the children of ctrl changed.
+
+    This happens automatically for invalidated controls at the next frame.
+    """
+    # Ancestors of the focused control may have changed
+    self.focus_path_of = None
+    # Walked with a stack instead of recursion, so deep trees are fine
+    stack = [ctrl]
+    while stack:
+      ctrl = stack.pop()
+      if ctrl is not self:
+        # Also for controls that are rendered inline by their parent, so their changes are noticed
+        object.__setattr__(ctrl, '_app', self)
+        if self.control_ids.get(ctrl) != ctrl.id:
+          self._index_id(ctrl, ctrl.id)
+
+      old = self.child_index.get(ctrl, ())
+      new = tuple(ctrl.children())
+      new_set = set(new)
+      for child in old:
+        if child not in new_set and self.parents.get(child) is ctrl:
+          self._unindex(child)
+      for child in reversed(new):
+        if self.parents.get(child) is not ctrl:
+          if child in self.parents:
+            # Moved from somewhere else
+            self._unindex(child)
+          self.parents[child] = ctrl
+          stack.append(child)
+      self.child_index[ctrl] = new
+
+  def _unindex(self, ctrl):
+    stack = [ctrl]
+    while stack:
+      ctrl = stack.pop()
+      for child in self.child_index.pop(ctrl, ()):
+        if self.parents.get(child) is ctrl:
+          stack.append(child)
+      self.parents.pop(ctrl, None)
+      self._index_id(ctrl, None)
+
+  def _index_id(self, ctrl, id):
+    old = self.control_ids.pop(ctrl, None)
+    if old is not None:
+      self.ids[old].remove(ctrl)
+      if not self.ids[old]:
+        del self.ids[old]
+    if id is not None:
+      self.control_ids[ctrl] = id
+      self.ids.setdefault(id, []).append(ctrl)
+
+  def _tree_position(self, ctrl):
+    """Return the path of child indexes that leads from the App to ctrl."""
+    ret = []
+    while ctrl in self.parents:
+      parent = self.parents[ctrl]
+      ret.append(self.child_index[parent].index(ctrl))
+      ctrl = parent
+    ret.reverse()
+    return ret
+
+  def find_in(self, root, id):
+    """Return the first control with the given id under root, or None."""
+    found = [c for c in self.ids.get(id, [])
+             if c.id == id and root in self.ancestors(c)]
+    if len(found) > 1:
+      found.sort(key=self._tree_position)
+    return found[0] if found else None
+
+  def ancestors(self, ctrl):
+    """Return the control and all of its parents, up to the App."""
+    ret = []
+    while ctrl:
+      ret.append(ctrl)
+      ctrl = self.get_parent(ctrl)
+    return ret
 
   def contains_focus(self, ctrl):
-    return self.find_ancestor(self.active_layer.focused, [ctrl]) is not None
+    object.__setattr__(ctrl, '_focus_dependent', True)
+    return ctrl in self._current_focus_path()
+
+  def _current_focus_path(self):
+    focused = self.active_layer.focused
+    if focused is not self.focus_path_of:
+      self.focus_path = set(self.ancestors(focused))
+      self.focus_path_of = focused
+    return self.focus_path
 
   def find_ancestor(self, ctrl, set):
     """Find parent from a set of parents."""
@@ -1381,56 +3711,465 @@ class App(Control):
     return self.find_ancestor(ctrl, self.layers)
 
   def get_color(self, fore, back):
-    tup = (fore, back)
-    if tup not in self.color_cache:
-      curses.init_pair(self.color_counter, fore, back)
-      self.color_cache[tup] = self.color_counter
-      self.color_counter += 1
-    return self.color_cache[tup]
+    return self.colors.get(fore, back)
+
+  def profile(self, enabled=True):
+    """Turn profiling on or off. See Profiler and stats()."""
+    if enabled and not self.profiler:
+      self.profiler = Profiler()
+    if not enabled:
+      self.show_stats(False)
+      self.profiler = None
+
+  def profiled(self, what, ctrl, fn, *args):
+    """Call fn(*args), timing it as work of ctrl."""
+    if isinstance(ctrl, (StatsOverlay, StatsBox)):
+      # Don't let the stats time themselves
+      return fn(*args)
+    self.profiler.begin(what, ctrl)
+    try:
+      return fn(*args)
+    finally:
+      self.profiler.end()
+
+  def stats(self):
+    """Return what the profiler found, or None if it is off."""
+    return self.profiler.stats() if self.profiler else None
+
+  def show_stats(self, visible=None):
+    """Show or hide the profiler stats on top of the screen (toggles by default)."""
+    if visible is None:
+      visible = not self.stats_layer
+    if visible and not self.stats_layer:
+      self.profile()
+      self.stats_layer = self.push_layer(StatsOverlay(), modal=False)
+    if not visible and self.stats_layer:
+      self.stats_layer.remove()
+      self.stats_layer = None
+
+  @property
+  def screen(self):
+    return self._screen
+
+  @screen.setter
+  def screen(self, screen):
+    self._screen = screen
+    terminal = screen if isinstance(screen, VirtualScreen) else curses
+    if terminal is not self.colors.terminal:
+      self.colors = ColorPairs(self.colors.common, terminal)
+
+  @property
+  def headless(self):
+    return isinstance(self.screen, VirtualScreen)
+
+  def input_fileno(self):
+    """Return the file descriptor that becomes readable when there are keys."""
+    return self.screen.fileno() if self.headless else sys.stdin.fileno()
 
   @property
   def ch_wait_time(self):
+    self.compact_timers()
     if self.timers:
       # Time until next timer
-      return max(0, int((self.timers[0][0] - datetime.datetime.now()).total_seconds() * 1000))
+      return max(0, int(math.ceil((self.timers[0][0] - monotonic()) * 1000)))
     # Indefinite wait
     return -1
 
   def fire_timers(self):
-    now = datetime.datetime.now()
-    while self.timers and self.timers[0][0] <= now:
-      _, on_time, _ = self.timers.pop(0)
-      on_time(self)
+    now = monotonic()
+    due = []
+    while self.timers and self.timers[0][0] <= now + self.timer_slack:
+      entry = heapq.heappop(self.timers)
+      handle = entry[2]
+      if handle.cancelled:
+        self.cancelled_timers -= 1
+      else:
+        # Out of the queue, so cancelling it from a callback below leaves the count alone
+        handle.pending = False
+        due.append(entry)
+
+    for deadline, timer_id, handle in due:
+      if handle.cancelled:
+        continue
+      if handle.interval is not None:
+        # If we fell behind, skip the missed repeats instead of catching up
+        deadline = max(deadline + handle.interval, now)
+        handle.pending = True
+        heapq.heappush(self.timers, (deadline, timer_id, handle))
+      result = handle.on_time(self)
+      if is_task(result):
+        self.spawn(result)
+
+  def add_reader(self, f, on_ready):
+    """Call on_ready(app) whenever f (a file or file descriptor) is readable.
+
+    There can be one reader per file descriptor; remove_reader() it before
+    adding another. Tasks that wait for a file share one reader, so any
+    number of them can wait for the same file. If on_ready returns a task, it
+    is spawned.
+    """
+    fd = fileno(f)
+    if fd in self.readers:
+      raise ValueError('File descriptor %d already has a reader' % fd)
+    self.readers[fd] = on_ready
+
+  def remove_reader(self, f):
+    self.readers.pop(fileno(f), None)
+
+  def post(self, fn):
+    """Call fn(app) on the UI thread, soon.
+
+    This is the only method that is safe to call from other threads. Use it to
+    update controls from there.
+    """
+    self.posted.append(fn)
+    try:
+      os.write(self.wakeup_w, 'x')
+    except OSError, e:
+      # If the pipe is full, the UI thread has plenty of wakeups already
+      if e.errno != errno.EAGAIN:
+        raise
+
+  def run_posted(self, app=None):
+    try:
+      while os.read(self.wakeup_r, 4096):
+        pass
+    except OSError, e:
+      if e.errno != errno.EAGAIN:
+        raise
+    while self.posted:
+      result = self.posted.popleft()(self)
+      if is_task(result):
+        self.spawn(result)
+
+  def run_in_background(self, fn, on_done=None, on_error=None, args=(), kwargs=None, processes=False):
+    """Call fn(*args, **kwargs) on a worker thread, without blocking the UI.
+
+    When it returns, on_done(app, result) is called on the UI thread. If it
+    raises, on_error(app, exception) is called instead, or the exception is
+    raised on the UI thread if there is no on_error. With processes=True, a
+    process pool is used for CPU-heavy work; fn and its arguments and result
+    must then be picklable.
+    """
+    if processes not in self.pools:
+      self.pools[processes] = (multiprocessing.Pool() if processes
+                               else multiprocessing.pool.ThreadPool())
+
+    def finished(outcome):
+      ok, value = outcome
+      def deliver(app):
+        if ok:
+          if on_done:
+            return on_done(app, value)
+        elif on_error:
+          return on_error(app, value)
+        else:
+          raise value
+      self.post(deliver)
+
+    self.pools[processes].apply_async(call_catching, (fn, args, kwargs or {}), callback=finished)
+
+  def close_pools(self):
+    for pool in self.pools.values():
+      pool.terminate()
+    self.pools = {}
+
+  def close(self):
+    """Stop the worker pools, and close the pipe that post() wakes us up with.
+
+    run() does this when it returns. Apps that are only updated, without
+    run(), should call it when they are done.
+    """
+    self.close_pools()
+    if self.wakeup_r is not None:
+      self.remove_reader(self.wakeup_r)
+      os.close(self.wakeup_r)
+      os.close(self.wakeup_w)
+      self.wakeup_r = self.wakeup_w = None
+
+  def spawn(self, task):
+    """Run a task: a generator that yields whenever it has to wait.
+
+    Yield a timedelta or a number of seconds to sleep, or a file (anything
+    with a fileno()) to wait until it is readable. Event handlers, on_click
+    handlers and timers may also be generators, which are spawned for them.
+    """
+    self._step_task(task)
+
+  def _step_task(self, task):
+    try:
+      wait = next(task)
+    except StopIteration:
+      return
+
+    if isinstance(wait, (datetime.timedelta, int, long, float)):
+      self.enqueue(wait, lambda app: self._step_task(task))
+    else:
+      fd = fileno(wait)
+      if fd not in self.waiting_tasks:
+        self.add_reader(fd, lambda app: self._wake_tasks(fd))
+        self.waiting_tasks[fd] = []
+      self.waiting_tasks[fd].append(task)
+
+  def _wake_tasks(self, fd):
+    self.remove_reader(fd)
+    for task in self.waiting_tasks.pop(fd):
+      self._step_task(task)
+
+  def wait_for_input(self, timeout_ms):
+    """Wait until stdin or any of the readers is ready, or until the timeout.
+
+    Returns the ready file descriptors.
+    """
+    fds = [self.input_fileno()] + list(self.readers)
+    try:
+      ready, _, _ = select.select(fds, [], [], None if timeout_ms < 0 else timeout_ms / 1000.0)
+      return ready
+    except select.error, e:
+      if e.args[0] != errno.EINTR:
+        raise
+      # Probably SIGWINCH, which curses reports as a key
+      return [self.input_fileno()]
 
   def run(self, screen):
-    curses.nonl()  # We need Ctrl-J!
-    curses.curs_set(0)
+    """Run the app on a curses screen, or on a VirtualScreen."""
     self.screen = screen
-    while not self.exit:
-      self.update()
-      self.screen.timeout(self.ch_wait_time)
-      try:
+    if not self.headless:
+      curses.nonl()  # We need Ctrl-J!
+      curses.curs_set(0)
+      set_bracketed_paste(True)
+    try:
+      while not self.exit:
+        self.update()
+        ready = []
+        try:
+          ready = self.wait_for_input(self.ch_wait_time)
+          if self.input_fileno() in ready:
+            # Handle all input that came in before drawing again
+            self.screen.timeout(0)
+            for type, what in self.read_input():
+              if self.exit:
+                break
+              self.dispatch_event(Event(type, what, self.active_layer.focused, self))
+        except KeyboardInterrupt:
+          # Just another kind of event
+          self.dispatch_event(Event('break', None, self.active_layer.focused, self))
+        for fd in ready:
+          if fd in self.readers:
+            result = self.readers[fd](self)
+            if is_task(result):
+              self.spawn(result)
+        self.fire_timers()
+    finally:
+      if not self.headless:
+        set_bracketed_paste(False)
+      self.close()
+
+  def read_input(self):
+    """Wait for input, then read everything that is available.
+
+    Returns a list of (type, what) pairs for events.
+    """
+    c = self.screen.getch()
+    if c == -1:
+      return []
+
+    self.screen.timeout(0)
+    while c != -1:
+      self.input.feed(c)
+      c = self.screen.getch()
+      if c == -1 and self.input.incomplete:
+        self.screen.timeout(PASTE_WAIT_MS)
         c = self.screen.getch()
-        if c != -1:
-          self.dispatch_event(Event('key', c, self.active_layer.focused, self))
-      except KeyboardInterrupt:
-        # Just another kind of event
-        self.dispatch_event(Event('break', None, self.active_layer.focused, self))
-      self.fire_timers()
+        self.screen.timeout(0)
+    self.input.flush()
+    return self.input.take_events()
+
+  def invalidate(self):
+    """Paint the whole screen again on the next frame."""
+    self.screen_layout = None
+
+  def current_view(self, ctrl):
+    """Return the View of a control, rendering it only if it changed."""
+    view = self.views.get(ctrl)
+    if view is None or ctrl._dirty:
+      object.__setattr__(ctrl, '_app', self)
+      view = self.profiled('render', ctrl, ctrl.render, self) if self.profiler else ctrl.render(self)
+      object.__setattr__(ctrl, '_dirty', False)
+      self.views[ctrl] = view
+      self.sizes.pop(ctrl, None)
+    return view
+
+  def measure(self, view, rect):
+    """Return the size of a view, measuring it only once per frame."""
+    key = (view, rect.w, rect.h)
+    size = self.measured.get(key)
+    if size is None:
+      size = self.measured[key] = view.size(rect)
+    return size
+
+  def control_size(self, ctrl, rect):
+    """Return the size of a control's View, measuring it only if it changed."""
+    key = (rect.w, rect.h)
+    cached = self.sizes.get(ctrl)
+    if cached is None or cached[0] != key or ctrl._dirty:
+      view = self.current_view(ctrl)
+      cached = (key, self.profiled('size', ctrl, view.size, rect) if self.profiler else view.size(rect))
+      self.sizes[ctrl] = cached
+    return cached[1]
 
   def update(self):
+    if self.profiler:
+      self.profiler.start_frame()
     h, w = self.screen.getmaxyx()
 
+    for ctrl in list(self.dirty):
+      if ctrl in self.parents:
+        self.reindex(ctrl)
+
+    self._invalidate_focus_change()
+    dirty, self.dirty = self.dirty, set()
+    self.painted = set()
+    self.measured = {}
+
+    self.colors.next_frame()
+    screen_layout = ((w, h), [l.id for l in self.layers])
+    if screen_layout != self.screen_layout or not self._paint_dirty(dirty):
+      self._paint_all()
+      self.screen_layout = screen_layout
+    if self.colors.evicted:
+      # Parts of the screen changed color along with the pairs that were reused
+      self.colors.evicted = False
+      self.colors.next_frame()
+      self._paint_all()
+      self.colors.evicted = False
+
+    # Controls that invalidated themselves while rendering are done
+    self.dirty = set(c for c in self.dirty if c._dirty)
+    self.measured = {}
+    self.screen.refresh()
+    if self.profiler:
+      self.profiler.end_frame()
+
+  def _invalidate_focus_change(self):
+    """Invalidate the controls that look different because focus moved."""
+    focused = self.active_layer.focused
+    if focused is self.focus_shown:
+      return
+    old_path = set(self.ancestors(self.focus_shown))
+    for ctrl in old_path.symmetric_difference(self._current_focus_path()):
+      if ctrl._focus_dependent:
+        ctrl._mark_dirty()
+    self.focus_shown = focused
+
+  def _paint_all(self):
+    h, w = self.screen.getmaxyx()
+    self.regions = {}
     self.screen.erase()
     for layer in self.layers:
-      view = layer.render(self)
-      view.display(Rect(self, self.screen, 0, 0, w, h))
-    self.screen.refresh()
+      layer.view(self).display(self._paint_rect(0, 0, w, h))
+
+    # Forget about controls that are no longer on the screen
+    for cache in [self.views, self.sizes]:
+      for ctrl in list(cache):
+        if ctrl not in self.regions:
+          del cache[ctrl]
+
+  def _paint_dirty(self, dirty):
+    """Paint only the parts of the screen that changed.
+
+    Returns False if the whole screen needs to be painted instead.
+    """
+    roots = []
+    for ctrl in dirty:
+      path = self.ancestors(ctrl)
+      if not ctrl._dirty or path[-1] is not self:
+        # Already rendered, or not on the screen
+        continue
+      if ctrl not in self.regions:
+        # Rendered inline by a parent (or not shown), so the nearest painted ancestor renders again
+        object.__setattr__(ctrl, '_dirty', False)
+        owners = [i for i, p in enumerate(path) if p in self.regions]
+        if not owners:
+          return False
+        path = path[owners[0]:]
+        ctrl = path[0]
+        object.__setattr__(ctrl, '_dirty', True)
+      parents = path[1:-1]
+      for parent in parents:
+        self.sizes.pop(parent, None)
+      if not any(p._dirty for p in parents):
+        roots.append(path)
+
+    targets = []
+    for path in roots:
+      if path[0] in self.painted:
+        continue
+      target = self._repaint_target(path[0])
+      if target is None:
+        return False
+      targets.append((self.layers.index(path[-2]), target))
+    if not targets:
+      return True
+
+    lowest_layer = min(layer for layer, target in targets)
+    for layer, target in sorted(targets, key=lambda t: t[0]):
+      if layer == lowest_layer:
+        self._paint(target)
+      else:
+        # Painted along with the rest of its layer below
+        self._clear(target)
+
+    # Layers on top may overlap what we just painted
+    h, w = self.screen.getmaxyx()
+    for layer in self.layers[lowest_layer + 1:]:
+      layer.view(self).display(self._paint_rect(0, 0, w, h))
+    return True
+
+  def _repaint_target(self, ctrl):
+    """Return the control to paint again after ctrl changed.
+
+    If the size of ctrl changed, the layout of its parent may have changed as
+    well, so this is the nearest ancestor whose size stayed the same. Returns
+    None if the whole screen needs to be painted.
+    """
+    changed = ctrl
+    while not isinstance(changed, Layer):
+      parent = self.get_parent(changed)
+      if isinstance(parent, Layer) and parent is not self.layers[0]:
+        # Clearing the root of a layer on top would wipe out the layers below
+        return None
+      region = self.regions.get(changed)
+      if region:
+        rect, size = region
+        if self.control_size(changed, rect) == size:
+          return changed
+      changed = parent
+    return None
+
+  def _clear(self, ctrl):
+    rect, size = self.regions[ctrl]
+    w, h = clip_size(size, rect)
+    try:
+      Rect(self, self.screen, rect.x, rect.y, w, h).clear()
+    except curses.error, e:
+      logger.warn(e)
+
+  def _paint(self, ctrl):
+    self._clear(ctrl)
+    rect = self.regions[ctrl][0]
+    ctrl.view(self).display(self._paint_rect(rect.x, rect.y, rect.w, rect.h))
+
+  def _paint_rect(self, x, y, w, h):
+    screen = CountingScreen(self.screen, self.profiler) if self.profiler else self.screen
+    return Rect(self, screen, x, y, w, h)
 
   def dispatch_event(self, ev):
     tgt = ev.target
     while tgt and ev.propagating:
-      tgt.on_event(ev)
+      result = self.profiled('on_event', tgt, tgt.on_event, ev) if self.profiler else tgt.on_event(ev)
+      if is_task(result):
+        self.spawn(result)
       ev.last = tgt
       tgt = self.get_parent(tgt)
 
@@ -1444,6 +4183,10 @@ class App(Control):
         self.exit = True
         ev.stop()
 
+      if ev.key == STATS_KEY and self.profiler:
+        self.show_stats()
+        ev.stop()
+
       # If we got here with focus-shifting, set focus back to the first control
       if ev.key in [curses.KEY_DOWN, curses.ascii.TAB]:
         self.active_layer._focus_first()
@@ -1451,29 +4194,74 @@ class App(Control):
         self.active_layer._focus_last()
 
   def find(self, id):
-    for parent, child in object_tree(self):
-      if child.id == id:
-        return child
-    raise RuntimeError('No such control: %s' % id)
+    found = self.find_in(self, id)
+    if found:
+      return found
+    return super(App, self).find(id)
 
 
-def get_all(root, ids):
+def controls_by_id(root):
+  """Return all controls with an id under root, found in a single pass.
+
+  If an id occurs more than once, the control that find() would return wins.
+  """
+  ret = {}
+  for parent, child in object_tree(root):
+    if child.id is not None and child.id not in ret:
+      ret[child.id] = child
+  return ret
+
+
+def get_all(root, ids=None):
+  """Return the values of the controls with the given ids.
+
+  Without ids, return the values of all controls that have an id.
+  """
+  controls = controls_by_id(root)
+  if ids is None:
+    ids = controls.keys()
+
   ret = {}
   for id in ids:
-    obj = root.find(id)
+    if id not in controls:
+      raise RuntimeError('No such control: %s' % id)
+    obj = controls[id]
     if hasattr(obj, 'value'):
       ret[id] = obj.value
   return ret
 
 
 def set_all(root, dct):
+  controls = controls_by_id(root)
   for id, value in dct.iteritems():
-    try:
-      obj = root.find(id)
-      if hasattr(obj, 'value'):
-        obj.value = value
-    except RuntimeError:
-      pass
+    obj = controls.get(id)
+    if obj is not None and hasattr(obj, 'value'):
+      obj.value = value
+
+
+class Snapshots(object):
+  """Takes snapshots of the values of all controls with an id under root.
+
+  changes() returns only the values that changed since the previous
+  snapshot, which is useful for autosaving or to see whether a form was
+  edited.
+  """
+  def __init__(self, root):
+    self.root = root
+    self.last = {}
+
+  def snapshot(self):
+    """Return all values, and remember them for the next call to changes()."""
+    self.last = get_all(self.root)
+    return dict(self.last)
+
+  def changes(self):
+    """Return the values that changed since the previous snapshot."""
+    current = get_all(self.root)
+    ret = dict((id, value) for id, value in current.iteritems()
+               if id not in self.last or self.last[id] != value)
+    self.last = current
+    return ret
 
 
 def walk(root):
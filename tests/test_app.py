@@ -0,0 +1,157 @@
+"""Tests for the App's event loop machinery."""
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sailor as s
+from test_repaint import AppTestCase, start
+
+
+class TimerTest(AppTestCase):
+  def test_cancel_due_timer_from_callback(self):
+    app = start(s.Text('timers'))
+    fired = []
+    later = []
+    def first(app):
+      fired.append('first')
+      later[0].cancel()
+    app.enqueue(0, first)
+    later.append(app.enqueue(0, lambda app: fired.append('second')))
+    app.fire_timers()
+    self.assertEqual(fired, ['first'])
+    self.assertEqual(app.cancelled_timers, 0)
+    self.assertEqual(app.timers, [])
+
+  def test_cancel_repeating_timer_from_its_callback(self):
+    app = start(s.Text('timers'))
+    fired = []
+    def tick(app):
+      fired.append(1)
+      handle.cancel()
+    handle = app.enqueue(0, tick, repeat=True)
+    app.fire_timers()
+    app.fire_timers()
+    self.assertEqual(fired, [1])
+    self.assertEqual(app.cancelled_timers, 0)
+    self.assertEqual(app.timers, [])
+
+
+class ReaderTest(AppTestCase):
+  def test_second_reader_for_fd_is_rejected(self):
+    app = start(s.Text('readers'))
+    r, w = os.pipe()
+    try:
+      app.add_reader(r, lambda app: None)
+      self.assertRaises(ValueError, app.add_reader, r, lambda app: None)
+      app.remove_reader(r)
+      app.add_reader(r, lambda app: None)
+    finally:
+      os.close(r)
+      os.close(w)
+
+  def test_reader_returning_task_is_spawned(self):
+    screen = s.VirtualScreen(20, 5)
+    app = s.App(s.Text('readers'))
+    r, w = os.pipe()
+    steps = []
+    def on_ready(app):
+      app.remove_reader(r)
+      os.read(r, 1)
+      steps.append('read')
+      yield 0
+      steps.append('done')
+      app.exit = True
+    app.add_reader(r, on_ready)
+    os.write(w, 'x')
+    try:
+      app.run(screen)
+    finally:
+      screen.close()
+      os.close(r)
+      os.close(w)
+    self.assertEqual(steps, ['read', 'done'])
+
+  def test_tasks_wait_for_same_file(self):
+    app = start(s.Text('readers'))
+    r, w = os.pipe()
+    f = os.fdopen(r, 'r', 0)
+    woken = []
+    def task(name):
+      yield f
+      woken.append(name)
+    try:
+      app.spawn(task('one'))
+      app.spawn(task('two'))
+      self.assertEqual(len(app.waiting_tasks[r]), 2)
+      self.assertRaises(ValueError, app.add_reader, r, lambda app: None)
+      os.write(w, 'x')
+      app.readers[r](app)
+      self.assertEqual(woken, ['one', 'two'])
+      self.assertEqual(app.readers.get(r), None)
+    finally:
+      f.close()
+      os.close(w)
+
+class ProfilerTest(AppTestCase):
+  def test_apps_profile_separately(self):
+    profiled = start(s.Panel([s.Text('profiled')]))
+    other = start(s.Panel([s.Text('other')]))
+    profiled.show_stats()
+    profiled.update()
+    calls = profiled.profiler.counts['curses_calls']
+    other.invalidate()
+    other.update()
+    self.assertEqual(profiled.profiler.counts['curses_calls'], calls)
+    self.assertEqual(other.profiler, None)
+
+  def test_stats_overlay_is_not_timed(self):
+    app = start(s.Panel([s.Text('profiled')]))
+    app.show_stats()
+    app.update()
+    app.update()
+    names = [c['control'] for c in app.stats()['controls']]
+    self.assertIn('Panel', names)
+    self.assertNotIn('StatsOverlay', names)
+    self.assertNotIn('StatsBox', names)
+
+  def test_stats_overlay_is_painted_on_its_own(self):
+    text = s.Text('before')
+    others = [s.Text('other %d' % i) for i in range(20)]
+    app = start(s.Panel([s.Panel([text])] + others), 100, 30)
+    app.show_stats()
+    app.update()
+    full_paints = []
+    paint_all = app._paint_all
+    def counting_paint_all():
+      full_paints.append(1)
+      paint_all()
+    app._paint_all = counting_paint_all
+    for i in range(5):
+      text.value = 'after %d' % i
+      app.update()
+    self.assertEqual(full_paints, [])
+    calls = [f['curses_calls'] for f in list(app.profiler.frames)[-5:]]
+    self.assertIn('after 4', '\n'.join(app.screen.text()))
+    app._paint_all = paint_all
+    app.invalidate()
+    app.update()
+    full = app.profiler.frames[-1]['curses_calls']
+    # Only the text and the stats box are painted again
+    self.assertTrue(max(calls) < full / 2, (calls, full))
+
+
+class CloseTest(unittest.TestCase):
+  def test_run_closes_wakeup_pipe(self):
+    screen = s.VirtualScreen(20, 5, keys=[s.curses.ascii.ESC])
+    app = s.App(s.Text('bye'))
+    fds = [app.wakeup_r, app.wakeup_w]
+    app.run(screen)
+    screen.close()
+    for fd in fds:
+      self.assertRaises(OSError, os.fstat, fd)
+    self.assertEqual(app.readers, {})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,78 @@
+"""Tests for handing out color pairs when a terminal has few of them."""
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sailor as s
+from test_repaint import AppTestCase, start
+
+
+class Terminal(object):
+  COLORS = 256
+
+  def __init__(self, pairs):
+    self.COLOR_PAIRS = pairs
+    self.pairs = {}
+
+  def init_pair(self, pair, fg, bg):
+    self.pairs[pair] = (fg, bg)
+
+
+class ColorPairsTest(AppTestCase):
+  def test_pairs_are_reused_for_same_colors(self):
+    terminal = Terminal(16)
+    colors = s.ColorPairs([(s.white, s.black)], terminal=terminal)
+    pair = colors.get(s.red, s.black)
+    self.assertEqual(colors.get(s.red, s.black), pair)
+    self.assertEqual(terminal.pairs[pair], (s.red, s.black))
+    self.assertNotEqual(colors.get(s.white, s.black), pair)
+    self.assertFalse(colors.evicted)
+
+  def test_least_recently_used_pairs_are_evicted(self):
+    terminal = Terminal(9)  # 8 usable pairs
+    colors = s.ColorPairs([(s.white, s.black)], terminal=terminal)
+    for fg in range(20, 27):
+      colors.get(fg, s.black)
+      colors.next_frame()
+    colors.get(20, s.black)  # Used again, so the oldest is now 21
+    colors.next_frame()
+    self.assertFalse(colors.evicted)
+    pair = colors.get(100, s.black)
+    self.assertTrue(colors.evicted)
+    self.assertEqual(terminal.pairs[pair], (100, s.black))
+    self.assertNotIn((21, s.black), colors.pairs)
+    self.assertIn((20, s.black), colors.pairs)
+    # The common pair is never given away
+    self.assertIn((s.white, s.black), colors.pairs)
+
+  def test_pairs_used_in_this_frame_are_kept(self):
+    terminal = Terminal(5)  # 4 usable pairs
+    colors = s.ColorPairs(terminal=terminal)
+    for fg in range(20, 23):
+      colors.get(fg, s.black)
+    colors.next_frame()
+    colors.get(23, s.black)
+    colors.get(24, s.black)
+    self.assertIn((23, s.black), colors.pairs)
+    self.assertIn((24, s.black), colors.pairs)
+
+  def test_screen_has_right_colors_after_eviction(self):
+    texts = [s.Text('text %d' % i, fg=s.rgb(40 * i % 256, 100, 200)) for i in range(6)]
+    app = start(s.Panel(texts))
+    app.screen.COLOR_PAIRS = 12
+    app.colors = s.ColorPairs(terminal=app.screen)
+    app.invalidate()
+    app.update()
+    for round in range(4):
+      for i, text in enumerate(texts):
+        text.fg = s.rgb((40 * i + 90 * round) % 256, 50 * round, 200)
+      app.update()
+      for text in texts:
+        rect = app.regions[text][0]
+        ch, attr = app.screen.cells[rect.y][rect.x]
+        self.assertEqual(app.screen.pairs[(attr & s.curses.A_COLOR) >> 8][0], text.fg)
+
+
+if __name__ == '__main__':
+  unittest.main()
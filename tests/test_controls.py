@@ -0,0 +1,113 @@
+"""Tests for the behavior of individual controls."""
+import os
+import sys
+import tempfile
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sailor as s
+from test_repaint import AppTestCase, key, start
+
+
+class ComboTest(AppTestCase):
+  def test_enter_without_filter_matches_keeps_selection(self):
+    combo = s.Combo(['one', 'two', 'three'], index=1)
+    app = start(s.Panel([combo]))
+    key(app, '\r')
+    popup = app.layers[-1].root
+    for ch in '/z':
+      key(app, ch)
+    self.assertEqual(popup.inner.choice_index, None)
+    self.assertEqual(popup.inner.value, None)
+    key(app, '\r')
+    # The popup stays, since there is nothing to pick
+    self.assertIs(app.layers[-1].root, popup)
+    key(app, s.curses.ascii.ESC)
+    key(app, s.curses.ascii.ESC)
+    self.assertEqual(combo.value, 'two')
+
+  def test_choices_read_before_showing_still_expire(self):
+    calls = []
+    def choices():
+      calls.append(1)
+      return ['one', 'two']
+    combo = s.Combo(choices, ttl=60)
+    self.assertEqual(combo.value, 'one')
+    app = start(s.Panel([combo]))
+    self.assertEqual(len(calls), 1)
+    self.assertTrue(combo.expiry and combo.expiry.pending)
+    combo.fetched_at -= 60
+    app.update()
+    self.assertEqual(len(calls), 2)
+
+
+class SelectListTest(AppTestCase):
+  def test_filter_continues_once_per_scan(self):
+    select = s.SelectList(['choice %d' % i for i in range(50000)], 0)
+    app = start(s.Panel([select]))
+    select.set_filter('9')
+    select.set_filter('99')
+    # Back to the first scan, which is still going
+    select.set_filter('9')
+    self.assertEqual(len(app.timers), 2)
+    while app.timers:
+      app.fire_timers()
+    self.assertTrue(select.scan.done)
+    self.assertEqual(len(select.scan.matches), len([i for i in range(50000) if '9' in str(i)]))
+
+
+class PreviewPaneTest(AppTestCase):
+  def test_shown_file_is_read_by_line_range(self):
+    with tempfile.NamedTemporaryFile() as f:
+      f.write('one\ntwo\nthree\n')
+      f.flush()
+      text = s.MappedText(f.name)
+      text.index()
+      pane = s.PreviewPane('')
+      pane.buffer = text
+      self.assertEqual(text.text_range(1, 3), 'two\nthree')
+      self.assertEqual(pane.line_range(2, 10), ['three', ''])
+      self.assertRaises(ValueError, pane.append, 'four\n')
+
+  def test_only_visible_part_of_lines_is_read(self):
+    with tempfile.NamedTemporaryFile() as f:
+      f.write('x' * 100000 + 'long\n' + ''.join('line %d\n' % i for i in range(1000)))
+      f.flush()
+      pane = s.PreviewPane('')
+      app = start(s.Panel([pane]), 40, 10)
+      pane.show_file(app, f.name)
+      pane.buffer.index()
+      pane.set_query('line')
+      while not pane.search.done:
+        pane.search.step()
+      read = []
+      slice = pane.buffer.slice
+      def counting_slice(start, end):
+        read.append(end - start)
+        return slice(start, end)
+      pane.buffer.slice = counting_slice
+      pane.invalidate()
+      app.update()
+      self.assertTrue(read and max(read) <= 40, read)
+      screen = '\n'.join(app.screen.text())
+      self.assertIn('line 5', screen)
+      self.assertNotIn('line 9', screen)
+      self.assertTrue(len(read) < 20, read)
+
+  def test_replacing_shown_file_closes_it(self):
+    with tempfile.NamedTemporaryFile() as f:
+      f.write('one\ntwo\n')
+      f.flush()
+      pane = s.PreviewPane('')
+      app = start(s.Panel([pane]))
+      pane.show_file(app, f.name)
+      mapped = pane.buffer.map
+      pane.text = 'other'
+      self.assertTrue(mapped.closed if hasattr(mapped, 'closed') else True)
+      self.assertRaises(ValueError, mapped.read, 1)
+      app.update()
+      self.assertIn('other', '\n'.join(app.screen.text()))
+
+
+if __name__ == '__main__':
+  unittest.main()
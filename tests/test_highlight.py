@@ -0,0 +1,56 @@
+"""Tests for RegexHighlighter, which lexes again only around a change."""
+import os
+import random
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sailor as s
+
+
+RULES = {
+    'root': [
+        (r'\d+', s.yellow),
+        (r'[a-z]+', s.green),
+        (r'"', s.cyan, 0, 'string'),
+        ],
+    'string': [
+        (r'[^"\\]+', s.cyan),
+        (r'\\.', s.red),
+        (r'"', s.cyan, 0, 'root'),
+        ],
+    }
+
+
+class RegexHighlighterTest(unittest.TestCase):
+  def test_tokens(self):
+    tokens = s.RegexHighlighter(RULES).lex('ab 12 "x\\"y" c')
+    self.assertEqual([(start, end) for start, end, _, _ in tokens],
+                     [(0, 2), (3, 5), (6, 7), (7, 8), (8, 10), (10, 11), (11, 12), (13, 14)])
+
+  def test_edits_give_same_tokens_as_lexing_from_scratch(self):
+    rnd = random.Random(2)
+    highlighter = s.RegexHighlighter(RULES)
+    text = 'word 12 "string" more 3\n' * 20
+    for _ in range(300):
+      pos = rnd.randint(0, len(text))
+      if rnd.random() < 0.6:
+        text = text[:pos] + rnd.choice(['"', 'abc', '42', ' ', '\\"', '\n']) + text[pos:]
+      else:
+        text = text[:pos] + text[pos + rnd.randint(1, 5):]
+      self.assertEqual(highlighter.lex(text), s.RegexHighlighter(RULES).lex(text))
+
+  def test_quote_changes_state_of_the_rest(self):
+    highlighter = s.RegexHighlighter(RULES)
+    highlighter.lex('a b c')
+    tokens = highlighter.lex('"a b c')
+    self.assertEqual([fg for _, _, fg, _ in tokens], [s.cyan, s.cyan])
+
+  def test_styled_text(self):
+    styled = s.RegexHighlighter(RULES)('ab 12')
+    self.assertEqual(str(styled), 'ab 12')
+    self.assertEqual([fg for text, fg, _, _ in styled.spans if text.strip()], [s.green, s.yellow])
+
+
+if __name__ == '__main__':
+  unittest.main()
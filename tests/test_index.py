@@ -0,0 +1,81 @@
+"""Tests for the App's index of parents and ids."""
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sailor as s
+from test_repaint import AppTestCase, start
+
+
+class IndexTest(AppTestCase):
+  def setUp(self):
+    self.moved = s.Panel([s.Text('inner', id='inner')], id='moved')
+    self.left = s.Panel([self.moved], id='left')
+    self.right = s.Panel([s.Text('other')], id='right')
+    self.app = start(s.Panel([self.left, self.right]))
+
+  def move(self, first, second):
+    self.left.controls.remove(self.moved)
+    self.right.controls.append(self.moved)
+    first.invalidate()
+    second.invalidate()
+    self.app.update()
+
+  def test_parents(self):
+    inner = self.app.find('inner')
+    self.assertEqual(self.app.ancestors(inner)[:3], [inner, self.moved, self.left])
+
+  def test_reparent_old_parent_first(self):
+    self.move(self.left, self.right)
+    self.assertIs(self.app.get_parent(self.moved), self.right)
+    self.assertIs(self.right.find('inner'), self.app.find('inner'))
+    self.assertRaises(RuntimeError, self.left.find, 'inner')
+
+  def test_reparent_new_parent_first(self):
+    self.move(self.right, self.left)
+    self.assertIs(self.app.get_parent(self.moved), self.right)
+    self.assertIs(self.app.get_parent(self.app.find('inner')), self.moved)
+    self.assertRaises(RuntimeError, self.left.find, 'inner')
+
+  def test_removed_controls_leave_the_index(self):
+    inner = self.app.find('inner')
+    self.left.controls = []
+    self.app.update()
+    self.assertEqual(self.app.get_parent(self.moved), None)
+    self.assertNotIn('inner', self.app.ids)
+    self.assertNotIn(inner, self.app.parents)
+
+  def test_id_change(self):
+    inner = self.app.find('inner')
+    inner.id = 'renamed'
+    self.app.update()
+    self.assertIs(self.app.find('renamed'), inner)
+    self.assertRaises(RuntimeError, self.app.find, 'inner')
+
+  def test_first_in_tree_order_wins(self):
+    self.right.controls.insert(0, s.Text('second', id='inner'))
+    self.right.invalidate()
+    self.app.update()
+    self.assertEqual(self.app.find('inner').value, 'inner')
+    self.assertEqual(self.right.find('inner').value, 'second')
+
+
+  def test_deep_tree(self):
+    leaf = s.Text('leaf', id='leaf')
+    root = leaf
+    for _ in range(sys.getrecursionlimit() * 2):
+      root = s.Stacked([root])
+    app = s.App(root)
+    try:
+      self.assertEqual(len(app.ancestors(leaf)), sys.getrecursionlimit() * 2 + 3)
+      self.assertIs(app.find('leaf'), leaf)
+      app.layers[0].root.controls = []
+      app.reindex(app.layers[0].root)
+      self.assertNotIn(leaf, app.parents)
+    finally:
+      app.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,69 @@
+"""Tests for reading keys and bracketed pastes."""
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sailor as s
+from test_repaint import AppTestCase, start
+
+
+def feed(parser, text):
+  for c in text:
+    parser.feed(ord(c))
+
+
+class InputParserTest(unittest.TestCase):
+  def test_keys_around_paste(self):
+    parser = s.InputParser()
+    feed(parser, 'a\x1b[200~pasted\x1b[201~b')
+    self.assertEqual(parser.take_events(), [('key', ord('a')), ('paste', 'pasted'), ('key', ord('b'))])
+
+  def test_lone_escape_is_a_key(self):
+    parser = s.InputParser()
+    feed(parser, '\x1b')
+    self.assertTrue(parser.incomplete)
+    parser.flush()
+    self.assertEqual(parser.take_events(), [('key', s.curses.ascii.ESC)])
+
+  def test_escape_then_paste(self):
+    parser = s.InputParser()
+    feed(parser, '\x1b\x1b[200~x\x1b[201~')
+    self.assertEqual(parser.take_events(), [('key', s.curses.ascii.ESC), ('paste', 'x')])
+
+  def test_paste_split_across_reads(self):
+    parser = s.InputParser()
+    feed(parser, '\x1b[200~first ')
+    parser.flush()
+    self.assertEqual(parser.take_events(), [])
+    feed(parser, 'second\x1b[20')
+    parser.flush()
+    self.assertEqual(parser.take_events(), [])
+    feed(parser, '1~')
+    self.assertFalse(parser.incomplete)
+    self.assertEqual(parser.take_events(), [('paste', 'first second')])
+
+  def test_control_keys_are_dropped_from_paste(self):
+    parser = s.InputParser()
+    feed(parser, '\x1b[200~one\r\ntwo\x1b\x03\tthree\x7f\x1b[201~')
+    self.assertEqual(parser.take_events(), [('paste', 'one\ntwo\tthree')])
+
+
+class PasteTest(AppTestCase):
+  def test_paste_goes_to_edit(self):
+    edit = s.Edit('')
+    app = start(s.Panel([edit]))
+    app.dispatch_event(s.Event('paste', 'hello\nworld', edit, app))
+    self.assertEqual(edit.value, 'hello world')
+
+  def test_paste_does_not_press_buttons_or_exit(self):
+    clicks = []
+    button = s.Button('OK', on_click=lambda app: clicks.append(1))
+    app = start(s.Panel([button]))
+    app.dispatch_event(s.Event('paste', 'a \n\x1b', button, app))
+    self.assertEqual(clicks, [])
+    self.assertFalse(app.exit)
+
+
+if __name__ == '__main__':
+  unittest.main()
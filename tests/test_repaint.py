@@ -0,0 +1,105 @@
+"""Checks that painting only what changed gives the same screen as painting everything."""
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sailor as s
+
+
+# Apps that start() made, closed again in AppTestCase.tearDown
+started = []
+
+
+def start(root, width=80, height=24):
+  app = s.App(root)
+  app.screen = s.VirtualScreen(width, height)
+  started.append(app)
+  app.update()
+  return app
+
+
+def key(app, k):
+  if isinstance(k, str):
+    k = ord(k)
+  app.dispatch_event(s.Event('key', k, app.active_layer.focused, app))
+  app.update()
+
+
+class Inline(s.Control):
+  """Renders its child in its own view, instead of through child.view()."""
+  def __init__(self, child):
+    super(Inline, self).__init__()
+    self.controls = [child]
+
+  def render(self, app):
+    return s.Box(self.controls[0].render(app))
+
+
+class AppTestCase(unittest.TestCase):
+  """Closes the apps and screens that a test started."""
+  def tearDown(self):
+    while started:
+      app = started.pop()
+      app.close()
+      app.screen.close()
+
+
+class RepaintTest(AppTestCase):
+  def assertFullRepaintSame(self, app):
+    incremental = [list(row) for row in app.screen.cells]
+    app.invalidate()
+    app.update()
+    self.assertEqual('\n'.join(app.screen.text()),
+                     '\n'.join(''.join(ch for ch, _ in row).rstrip() for row in incremental))
+    self.assertEqual(app.screen.cells, incremental)
+
+  def test_edit_popup_grows(self):
+    app = start(s.Panel([s.Button('x')]))
+    s.EditPopup(app, lambda box, app: None, value='a' * 28)
+    app.update()
+    for ch in 'bcdef':
+      key(app, ch)
+      self.assertFullRepaintSame(app)
+
+  def test_combo_popup_filter_line(self):
+    app = start(s.Panel([s.Combo(['one', 'two', 'three'])]))
+    key(app, '\r')
+    key(app, '/')
+    self.assertFullRepaintSame(app)
+    key(app, 't')
+    self.assertFullRepaintSame(app)
+
+  def test_text_changes_size(self):
+    text = s.Text('short')
+    app = start(s.Panel([s.Labeled('label', text), s.Text('below')]))
+    for value in ['a much longer value than before', 'x', 'two\nlines', 'one']:
+      text.value = value
+      app.update()
+      self.assertFullRepaintSame(app)
+
+
+  def test_child_rendered_inline(self):
+    text = s.Text('before')
+    app = start(s.Panel([Inline(text), s.Text('below')]))
+    text.value = 'after'
+    app.update()
+    self.assertIn('after', '\n'.join(app.screen.text()))
+    self.assertFullRepaintSame(app)
+
+
+  def test_reading_values_paints_nothing(self):
+    combos = [s.Combo(['one', 'two'], id='combo%d' % i) for i in range(50)]
+    select = s.SelectList(['a', 'b'], 1, id='select')
+    root = s.Panel(combos + [select])
+    app = start(root)
+    snapshots = s.Snapshots(root)
+    snapshots.snapshot()
+    self.assertEqual(snapshots.changes(), {})
+    self.assertEqual(app.dirty, set())
+    combos[3].index = 1
+    self.assertEqual(app.dirty, set([combos[3]]))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,58 @@
+"""Tests for the Rope that TextArea keeps its text in."""
+import os
+import random
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sailor as s
+
+
+class RopeTest(unittest.TestCase):
+  def assertSameAs(self, rope, text):
+    self.assertEqual(rope.text, text)
+    self.assertEqual(len(rope), len(text))
+    lines = text.split('\n')
+    self.assertEqual(rope.line_count, len(lines))
+    pos = 0
+    for i, line in enumerate(lines):
+      self.assertEqual(rope.line_start(i), pos)
+      self.assertEqual(rope.line_end(i), pos + len(line))
+      self.assertEqual(rope.line_of(pos + len(line)), i)
+      pos += len(line) + 1
+
+  def test_build_in_chunks(self):
+    text = ''.join('line %d\n' % i for i in range(1000))
+    rope = s.Rope(text)
+    self.assertSameAs(rope, text)
+    self.assertEqual(rope.slice(100, 3000), text[100:3000])
+
+  def test_empty(self):
+    rope = s.Rope()
+    self.assertSameAs(rope, '')
+    rope.insert(0, 'a\nb')
+    self.assertSameAs(rope, 'a\nb')
+    rope.delete(0, 3)
+    self.assertSameAs(rope, '')
+
+  def test_random_edits(self):
+    rnd = random.Random(1)
+    text = ''.join('line %d\n' % i for i in range(300))
+    rope = s.Rope(text)
+    for _ in range(300):
+      pos = rnd.randint(0, len(text))
+      if rnd.random() < 0.6:
+        new = rnd.choice(['x', 'word\n', '\n\n', 'a longer piece of text ' * rnd.randint(1, 80)])
+        rope.insert(pos, new)
+        text = text[:pos] + new + text[pos:]
+      else:
+        end = pos + rnd.randint(0, 2000)
+        rope.delete(pos, end)
+        text = text[:pos] + text[end:]
+      start = rnd.randint(0, len(text))
+      self.assertEqual(rope.slice(start, start + 50), text[start:start + 50])
+    self.assertSameAs(rope, text)
+
+
+if __name__ == '__main__':
+  unittest.main()
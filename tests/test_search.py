@@ -0,0 +1,67 @@
+"""Tests for searching the lines of a document."""
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sailor as s
+from test_repaint import AppTestCase, start
+
+
+def run(search):
+  while not search.done:
+    search.step()
+  return list(search.matches)
+
+
+class LineSearchTest(unittest.TestCase):
+  def test_narrowed_search_finds_appended_lines(self):
+    buffer = s.TextBuffer('an err\nnothing\nan erro\n')
+    search = s.LineSearch(buffer, 'err')
+    self.assertEqual(run(search), [0, 2])
+    narrowed = search.narrowed('erro')
+    self.assertEqual(run(narrowed), [2])
+    buffer.append('an error here\n')
+    self.assertFalse(narrowed.done)
+    self.assertEqual(run(narrowed), [2, 3])
+    # The shorter search keeps its own matches
+    self.assertEqual(list(search.matches), [0, 2])
+
+  def test_unterminated_line_is_searched_again(self):
+    buffer = s.TextBuffer('')
+    search = s.LineSearch(buffer, 'bar')
+    buffer.append('foo ba')
+    self.assertEqual(run(search), [])
+    buffer.append('r\n')
+    self.assertEqual(run(search), [0])
+    buffer.append('bar again')
+    self.assertEqual(run(search), [0, 1])
+    buffer.append(' and bar\n')
+    self.assertEqual(run(search), [0, 1])
+
+  def test_candidates_are_searched_in_blocks(self):
+    buffer = s.TextBuffer('\n'.join('line %d' % i for i in xrange(20000)))
+    search = s.LineSearch(buffer, '7')
+    run(search)
+    narrowed = search.narrowed('77')
+    self.assertEqual(run(narrowed), [i for i in xrange(20000) if '77' in str(i)])
+
+
+class PreviewPaneSearchTest(AppTestCase):
+  def test_append_after_narrowing(self):
+    pane = s.PreviewPane('an err\n')
+    app = start(s.Panel([pane]))
+    pane.set_query('err')
+    pane.set_query('erro')
+    self.assertEqual(list(pane.search.matches), [])
+    pane.append('an error here\n')
+    for _ in range(3):
+      # Let the search continue in between frames
+      app.fire_timers()
+      app.update()
+    self.assertEqual(list(pane.search.matches), [1])
+    self.assertIn('(1 matches)', '\n'.join(app.screen.text()))
+
+
+if __name__ == '__main__':
+  unittest.main()